@@ -0,0 +1,290 @@
+"""analysis.py
+
+Aggregation of timecard log events for the analyze command.
+"""
+
+import array
+import bisect
+import datetime
+import timelog
+
+# numpy takes longer to import than most commands take to run, so it is
+# only imported once an EventTable is actually built.
+numpy = None
+_numpy_checked = False
+
+def have_numpy():
+    """Import numpy if it is installed, and return whether it is."""
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy is not None
+
+def accumulate(events, start_time=None, end_time=None, pairs=False):
+    """Total the time spent per command and per window name.
+
+    Each window event lasts until the next window event or the end of its
+    log segment; an unclosed segment simply ends at its last entry. With a
+    time range, durations are clipped to it, and whatever had no time in
+    it is left out.
+
+    Returns (command_histogram, window_histogram, pair_histogram), dicts of
+    timedeltas. pair_histogram is keyed by (command, window) and only
+    filled in if pairs is set.
+    """
+    command_histogram = {}
+    window_histogram = {}
+    pair_histogram = {}
+    in_segment = False
+    previous = None
+    for event in events:
+        if event.kind == timelog.START:
+            in_segment = True
+            previous = None
+            continue
+        elif not in_segment or event.kind not in (timelog.WINDOW, timelog.CLOSE):
+            continue
+        if previous is not None:
+            if start_time is not None:
+                elapsed = max(datetime.timedelta(0), min(event.timestamp, end_time) - max(previous.timestamp, start_time))
+            else:
+                elapsed = event.timestamp - previous.timestamp
+            # A window entirely outside the range gets no entry.
+            if elapsed or start_time is None:
+                command_histogram[previous.command] = command_histogram.get(previous.command, datetime.timedelta(0)) + elapsed
+                window_histogram[previous.window] = window_histogram.get(previous.window, datetime.timedelta(0)) + elapsed
+                if pairs:
+                    pair = (previous.command, previous.window)
+                    pair_histogram[pair] = pair_histogram.get(pair, datetime.timedelta(0)) + elapsed
+        previous = event
+        in_segment = event.kind != timelog.CLOSE
+    return (command_histogram, window_histogram, pair_histogram)
+
+def _column(values, dtype):
+    """Wrap an array.array as a numpy array without copying it."""
+    if not values:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.frombuffer(values, dtype=dtype)
+
+class EventTable(object):
+    """A parsed log held as columns instead of one object per event.
+
+    times holds epoch seconds, kinds the event kind, and commands/windows
+    integer codes into the command_names/window_names intern tables. Only
+    the start, window and close events that accumulate() would look at are
+    kept. Requires numpy.
+    """
+    def __init__(self):
+        self.command_codes = {}
+        self.window_codes = {}
+        self.command_names = []
+        self.window_names = []
+
+    def _intern(self, codes, names, name):
+        code = codes.get(name)
+        if code is None:
+            code = codes[name] = len(names)
+            names.append(name)
+        return code
+
+    @classmethod
+    def from_events(cls, events):
+        if not have_numpy():
+            raise RuntimeError, "EventTable needs numpy"
+        table = cls()
+        times = array.array('d')
+        kinds = array.array('b')
+        commands = array.array('i')
+        windows = array.array('i')
+        in_segment = False
+        for event in events:
+            if event.kind == timelog.START:
+                in_segment = True
+            elif not in_segment or event.kind not in (timelog.WINDOW, timelog.CLOSE):
+                continue
+            times.append(timelog.to_epoch(event.timestamp))
+            kinds.append(event.kind)
+            if event.kind == timelog.WINDOW:
+                commands.append(table._intern(table.command_codes, table.command_names, event.command))
+                windows.append(table._intern(table.window_codes, table.window_names, event.window))
+            else:
+                commands.append(-1)
+                windows.append(-1)
+                in_segment = event.kind != timelog.CLOSE
+        table.times = _column(times, numpy.float64).astype(numpy.int64)
+        table.kinds = _column(kinds, numpy.int8)
+        table.commands = _column(commands, numpy.int32)
+        table.windows = _column(windows, numpy.int32)
+        return table
+
+    def durations(self, start_time=None, end_time=None):
+        """Return (mask, seconds) for window events followed by an event in the same segment."""
+        mask = (self.kinds[:-1] == timelog.WINDOW) & (self.kinds[1:] != timelog.START)
+        begin = self.times[:-1]
+        finish = self.times[1:]
+        if start_time is not None:
+            begin = numpy.maximum(begin, timelog.to_epoch(start_time))
+            finish = numpy.minimum(finish, timelog.to_epoch(end_time))
+        return (mask, numpy.maximum(finish - begin, 0)[mask])
+
+    def histogram(self, codes, names, mask, seconds, clipped=False):
+        """Total time per name; with clipped set, only names with time in the range."""
+        codes = codes[:-1][mask]
+        totals = numpy.bincount(codes, weights=seconds, minlength=len(names))
+        kept = numpy.flatnonzero(totals) if clipped else numpy.flatnonzero(numpy.bincount(codes, minlength=len(names)))
+        return {names[code]: datetime.timedelta(seconds=int(totals[code])) for code in kept}
+
+    def pair_histogram(self, mask, seconds, clipped=False):
+        """Total time per distinct (command, window) pair."""
+        width = max(len(self.window_names), 1)
+        codes = self.commands[:-1][mask].astype(numpy.int64) * width + self.windows[:-1][mask]
+        pairs, inverse = numpy.unique(codes, return_inverse=True)
+        totals = numpy.bincount(inverse, weights=seconds, minlength=len(pairs))
+        return {(self.command_names[code // width], self.window_names[code % width]): datetime.timedelta(seconds=int(total))
+                for code, total in zip(pairs.tolist(), totals.tolist()) if total or not clipped}
+
+    def accumulate(self, start_time=None, end_time=None, pairs=False):
+        """Same result as accumulate() over the events this table was built from."""
+        if len(self.times) < 2:
+            return ({}, {}, {})
+        mask, seconds = self.durations(start_time, end_time)
+        clipped = start_time is not None
+        return (self.histogram(self.commands, self.command_names, mask, seconds, clipped),
+                self.histogram(self.windows, self.window_names, mask, seconds, clipped),
+                self.pair_histogram(mask, seconds, clipped) if pairs else {})
+
+def columnar_accumulate(events, start_time=None, end_time=None, pairs=False):
+    """accumulate() via an EventTable, falling back to the plain loop without numpy."""
+    if not have_numpy():
+        return accumulate(events, start_time, end_time, pairs)
+    return EventTable.from_events(events).accumulate(start_time, end_time, pairs)
+
+def merge(histograms, partial):
+    """Add the totals in partial into histograms."""
+    for name, elapsed in partial.iteritems():
+        histograms[name] = histograms.get(name, datetime.timedelta(0)) + elapsed
+    return histograms
+
+def _accumulate_shard(shard):
+    path, start, end, start_time, end_time, pairs = shard
+    return columnar_accumulate(timelog.read_events(path, start, end), start_time, end_time, pairs)
+
+def parallel_accumulate(path, jobs, start=0, end=None, start_time=None, end_time=None, pairs=False):
+    """accumulate() over a log file, sharded at segment boundaries across processes."""
+    import multiprocessing
+    shards = [(path, s, e, start_time, end_time, pairs) for s, e in timelog.split_offsets(path, jobs, start, end)]
+    pool = multiprocessing.Pool(min(jobs, len(shards)))
+    try:
+        partials = pool.map(_accumulate_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+    command_histogram = {}
+    window_histogram = {}
+    pair_histogram = {}
+    for commands, windows, pair_totals in partials:
+        merge(command_histogram, commands)
+        merge(window_histogram, windows)
+        merge(pair_histogram, pair_totals)
+    return (command_histogram, window_histogram, pair_histogram)
+
+def _seconds(moment):
+    return timelog.to_epoch(moment) if isinstance(moment, datetime.datetime) else moment
+
+def _running_sums(values):
+    sums = [0]
+    for value in values:
+        sums.append(sums[-1] + value)
+    return sums
+
+class Coverage(object):
+    """Time covered by a set of intervals, for overlap queries against many ranges.
+
+    The interval starts and ends are kept sorted with running sums, so the
+    time covered before any moment takes two binary searches, and the
+    overlap with a range is the difference of two of those. Intervals may
+    overlap each other; each is counted on its own. Times are datetimes or
+    epoch seconds, and results are seconds.
+    """
+    def __init__(self, intervals):
+        starts = []
+        ends = []
+        for start, end in intervals:
+            start, end = _seconds(start), _seconds(end)
+            if end > start:
+                starts.append(start)
+                ends.append(end)
+        self.starts = sorted(starts)
+        self.ends = sorted(ends)
+        self.start_sums = _running_sums(self.starts)
+        self.end_sums = _running_sums(self.ends)
+
+    def before(self, moment):
+        """Seconds covered before moment."""
+        t = _seconds(moment)
+        started = bisect.bisect_left(self.starts, t)
+        ended = bisect.bisect_left(self.ends, t)
+        return (started * t - self.start_sums[started]) - (ended * t - self.end_sums[ended])
+
+    def overlap(self, start, end):
+        """Seconds covered between start and end."""
+        if end <= start:
+            return 0
+        return self.before(end) - self.before(start)
+
+    def total(self):
+        """Seconds covered in all."""
+        return self.end_sums[-1] - self.start_sums[-1]
+
+    def between(self, boundaries):
+        """Seconds covered between each pair of consecutive sorted boundaries."""
+        covered = [self.before(boundary) for boundary in boundaries]
+        return [b - a for a, b in zip(covered, covered[1:])]
+
+def clipped(start, end, range_start=None, range_end=None):
+    """Seconds of [start, end] within the range, or all of them without one."""
+    if range_start is not None:
+        start, end = max(start, range_start), min(end, range_end)
+    return max((end - start).total_seconds(), 0)
+
+def ranked(histogram, limit=None):
+    """Histogram items, longest first, with ties in name order."""
+    return sorted(histogram.items(), key=lambda e: (-e[1], e[0]))[:limit]
+
+
+if __name__ == "__main__":
+    # Tests: Coverage against brute force over random intervals and ranges.
+    import random
+    import sys
+    
+    def brute_overlap(intervals, start, end):
+        return sum(max(0, min(e, end) - max(s, start)) for s, e in intervals)
+    
+    rng = random.Random(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    for trial in xrange(500):
+        intervals = []
+        for i in xrange(rng.randint(0, 40)):
+            start = rng.randint(0, 1000)
+            # Zero-length, backwards and overlapping intervals all occur.
+            intervals.append((start, start + rng.randint(-20, 200)))
+        coverage = Coverage(intervals)
+        assert coverage.total() == brute_overlap(intervals, -1, 2000), intervals
+        for i in xrange(20):
+            start, end = sorted((rng.randint(-100, 1300), rng.randint(-100, 1300)))
+            assert coverage.overlap(start, end) == brute_overlap(intervals, start, end), (intervals, start, end)
+            assert coverage.overlap(end, start) == 0
+        boundaries = sorted(rng.randint(-100, 1300) for i in xrange(rng.randint(2, 30)))
+        assert coverage.between(boundaries) == [brute_overlap(intervals, a, b) for a, b in zip(boundaries, boundaries[1:])]
+    
+    epoch = datetime.datetime(2014, 4, 14, 9)
+    hour = datetime.timedelta(hours=1)
+    coverage = Coverage([(epoch, epoch + 8*hour), (epoch + 24*hour, epoch + 26*hour)])
+    assert coverage.overlap(epoch + 7*hour, epoch + 25*hour) == 2*3600
+    assert clipped(epoch, epoch + 8*hour, epoch + 2*hour, epoch + 3*hour) == 3600
+    assert clipped(epoch, epoch + 8*hour, epoch - hour, epoch + 9*hour) == 8*3600
+    assert clipped(epoch, epoch + 8*hour, epoch + 9*hour, epoch + 10*hour) == 0
+    print "All tests passed."
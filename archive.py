@@ -0,0 +1,257 @@
+"""archive.py
+
+Compressed archives of closed timecard logs.
+
+An archive is a text log compressed as a series of independent gzip, xz or
+zstd frames, each starting at a "-- Starting log" line, so it can still be
+read with the ordinary command line tools. A <archive>.idx sidecar lists
+every frame's offsets, time range and last [submitted] marker, so time
+range queries only decompress the frames they need. Offsets taken and
+returned here are positions in the uncompressed log, as for text logs.
+"""
+
+import os
+import json
+import zlib
+import gzip
+import bisect
+import cStringIO
+import timelog
+
+# The xz and zstd modules are imported when an archive first needs them.
+lzma = None
+zstandard = None
+
+INDEX_VERSION = 1
+FRAME_SIZE = 1 << 20 # uncompressed bytes, rounded up to the next span
+
+codecs = {'gz': '.gz', 'xz': '.xz', 'zst': '.zst'}
+
+is_archive = timelog.is_compressed
+
+def codec_of(path):
+    for codec, extension in codecs.items():
+        if path.endswith(extension):
+            return codec
+    return None
+
+def _require(codec):
+    global lzma, zstandard
+    if codec not in codecs:
+        raise ValueError, "unknown codec %s" % (codec,)
+    elif codec == 'xz' and lzma is None:
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise RuntimeError, "xz archives need the lzma module (backports.lzma on Python 2)"
+    elif codec == 'zst' and zstandard is None:
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError, "zstd archives need the zstandard module"
+
+def compress_frame(data, codec):
+    _require(codec)
+    if codec == 'gz':
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == 'xz':
+        return lzma.compress(data)
+    else:
+        return zstandard.ZstdCompressor(level=19, write_content_size=True).compress(data)
+
+def decompress_frame(data, codec):
+    _require(codec)
+    if codec == 'gz':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif codec == 'xz':
+        return lzma.decompress(data)
+    else:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+#########
+# Frame index
+
+def index_path(path):
+    return path + '.idx'
+
+def load_index(path):
+    """Load the frame index of an archive, or None if it is missing or stale."""
+    try:
+        with open(index_path(path), 'r') as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    frames = index.get('frames')
+    if index.get('version') != INDEX_VERSION or not frames:
+        return None
+    if frames[-1]['position'] + frames[-1]['size'] != os.path.getsize(path):
+        return None
+    return index
+
+def save_index(path, index):
+    temp_path = index_path(path) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(index, f)
+    os.rename(temp_path, index_path(path))
+
+def _epoch(dt):
+    return timelog.to_epoch(dt) if dt is not None else None
+
+def _write_frame(f, index, lines):
+    data = ''.join(lines)
+    events = list(timelog.iter_events(lines))
+    submitted = [e.timestamp for e in events if e.kind == timelog.SUBMITTED]
+    previous = index['frames'][-1] if index['frames'] else None
+    compressed = compress_frame(data, index['codec'])
+    index['frames'].append({
+        'offset': previous['offset'] + previous['length'] if previous else 0,
+        'length': len(data),
+        'position': f.tell(),
+        'size': len(compressed),
+        'start': _epoch(min(e.timestamp for e in events)) if events else None,
+        'end': _epoch(max(e.timestamp for e in events)) if events else None,
+        'last_paid': _epoch(max(submitted)) if submitted else None
+    })
+    f.write(compressed)
+
+def compress(source, destination, codec='gz', start=0, end=None, frame_size=FRAME_SIZE):
+    """Write bytes [start, end) of a text log as a framed archive with an index.
+
+    start must be a line boundary. Returns the number of frames written.
+    """
+    _require(codec)
+    index = {'version': INDEX_VERSION, 'codec': codec, 'frames': []}
+    lines = []
+    buffered = 0
+    with open(source, 'r') as f:
+        with open(destination, 'wb') as out:
+            f.seek(start)
+            position = start
+            for line in f:
+                position += len(line)
+                if end is not None and position > end:
+                    break
+                if buffered >= frame_size and line.startswith("-- Starting log"):
+                    _write_frame(out, index, lines)
+                    lines = []
+                    buffered = 0
+                lines.append(line)
+                buffered += len(line)
+            if lines or not index['frames']:
+                _write_frame(out, index, lines)
+    save_index(destination, index)
+    return len(index['frames'])
+
+#########
+# Reading
+
+def _open_stream(path, codec):
+    _require(codec)
+    if codec == 'gz':
+        return gzip.open(path, 'rb')
+    elif codec == 'xz':
+        return lzma.LZMAFile(path, 'rb')
+    else:
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+
+def _stream_lines(f, blocksize=65536):
+    pending = ''
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        lines = (pending + block).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def read_lines(path, start=0, end=None):
+    """Yield the lines of an archive between uncompressed offsets."""
+    index = load_index(path)
+    if index is None:
+        # No seek points; decompress from the beginning.
+        position = 0
+        with _open_stream(path, codec_of(path)) as f:
+            for line in _stream_lines(f):
+                line_start = position
+                position += len(line)
+                if end is not None and position > end:
+                    break
+                if line_start >= start:
+                    yield line
+        return
+    with open(path, 'rb') as f:
+        for frame in index['frames']:
+            if frame['offset'] + frame['length'] <= start:
+                continue
+            elif end is not None and frame['offset'] >= end:
+                break
+            f.seek(frame['position'])
+            data = decompress_frame(f.read(frame['size']), index['codec'])
+            first = max(start - frame['offset'], 0)
+            last = len(data) if end is None else min(end - frame['offset'], len(data))
+            for line in cStringIO.StringIO(data[first:last]):
+                yield line
+
+def read_events(path, start=0, end=None):
+    """Archive version of timelog.read_events()."""
+    return timelog.iter_events(read_lines(path, start, end))
+
+def complete_length(path):
+    """Uncompressed length of an archive, or None without an index."""
+    index = load_index(path)
+    if index is None:
+        return None
+    return index['frames'][-1]['offset'] + index['frames'][-1]['length']
+
+def range_offsets(path, start_time, end_time):
+    """Archive version of timelog.range_offsets(), to frame granularity.
+
+    Frames hold whole spans, so the frames stamped within the range cover
+    any span straddling its edges.
+    """
+    index = load_index(path)
+    if index is None:
+        return (0, None)
+    start, end = _epoch(start_time), _epoch(end_time)
+    frames = [f for f in index['frames'] if f['start'] is not None and f['end'] >= start and f['start'] <= end]
+    if not frames:
+        return (0, 0)
+    return (frames[0]['offset'], frames[-1]['offset'] + frames[-1]['length'])
+
+def split_offsets(path, count, start=0, end=None):
+    """Archive version of timelog.split_offsets(), cutting at frame boundaries."""
+    index = load_index(path)
+    if index is None:
+        return [(start, end)]
+    end = complete_length(path) if end is None else end
+    cuts = [f['offset'] for f in index['frames'] if start < f['offset'] < end]
+    shards = []
+    begin = start
+    for n in xrange(1, count):
+        i = bisect.bisect_left(cuts, start + (end - start) * n // count)
+        if i >= len(cuts):
+            break
+        if cuts[i] > begin:
+            shards.append((begin, cuts[i]))
+            begin = cuts[i]
+    shards.append((begin, end))
+    return shards
+
+def find_last_paid(path):
+    """Archive version of timelog.find_last_paid()."""
+    index = load_index(path)
+    if index is None:
+        last_paid = None
+        for event in read_events(path):
+            if event.kind == timelog.SUBMITTED:
+                last_paid = event.timestamp
+        return last_paid
+    paid = [f['last_paid'] for f in index['frames'] if f['last_paid'] is not None]
+    return timelog.from_epoch(max(paid)) if paid else None
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+
+"""benchmark.py
+
+Timing harness for the timecard log reporting path, command start-up
+and screenshot encoding.
+
+Generates a synthetic log, times the reporting commands against it and
+writes the results as JSON, so runs can be compared between releases.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import argparse
+import datetime
+import tempfile
+import subprocess
+from dateutil import parser as dateparser
+import timelog
+import analysis
+import rollup
+import screenshot
+import timecard
+
+def format_timestamp(dt):
+    return dt.strftime("%H:%M:%S, %a %b %d, %Y")
+
+#########
+# Synthetic logs
+
+chrome = "/opt/google/chrome/chrome"
+
+def chrome_titles(rng):
+    """Yield the titles a busy browser tab goes through, Gmail/Slack style."""
+    page = rng.choice(["Inbox (%d) - me@example.com - Gmail", "Slack - #general (%d)", "Pull Request #%d - GitHub", "(%d) YouTube"])
+    if rng.random() < 0.3:
+        yield "Loading... - Google Chrome"
+    for i in xrange(rng.choice([1, 1, 1, 2, 5, 20])):
+        yield "%s - Google Chrome" % (page % (rng.randint(0, 40)))
+
+def terminal_titles(rng):
+    yield "me@workstation: ~/src/project%d" % (rng.randint(0, 9))
+    if rng.random() < 0.2:
+        # Live title from a long-running job.
+        for percent in xrange(0, 101, rng.choice([5, 10, 25])):
+            yield "make - %d%% - me@workstation: ~/src" % (percent)
+
+def editor_titles(rng):
+    yield "%s.py - project%d - Sublime Text" % (rng.choice(["timecard", "models", "views", "utils"]), rng.randint(0, 9))
+
+applications = [
+    (chrome, chrome_titles, 0.45),
+    ("/usr/bin/gnome-terminal", terminal_titles, 0.25),
+    ("/opt/sublime_text/sublime_text", editor_titles, 0.2),
+    ("/usr/bin/libreoffice --calc", lambda rng: iter(["invoice-%d.ods - LibreOffice Calc" % (rng.randint(1, 99))]), 0.1)
+]
+
+def pick_application(rng):
+    r = rng.random()
+    for command, titles, weight in applications:
+        if r < weight:
+            return (command, titles)
+        r -= weight
+    return applications[0][:2]
+
+def generate_lines(count, seed=0):
+    """Yield about count synthetic log lines, as the timecard commands write them.
+
+    Work happens in clocked-in sessions of a few hours, a few per weekday.
+    Sessions are mostly window events with browser and terminal title churn,
+    plus the occasional note and manual adjustment. Hours are submitted
+    every other Friday.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime(2012, 1, 2, 9, 0, 0)
+    written = 0
+    while written < count:
+        yield "-- Starting log at %s --" % (format_timestamp(now))
+        written += 1
+        session_end = now + datetime.timedelta(hours=rng.uniform(0.5, 4))
+        while now < session_end and written < count - 1:
+            r = rng.random()
+            if r < 0.005:
+                yield "%s -- [Note] %s" % (format_timestamp(now), rng.choice(["Standup", "Lunch", "Reviewing PR #%d" % (rng.randint(1, 999))]))
+                written += 1
+            elif r < 0.006:
+                yield "%s -- [Manual Adjustment] %d" % (format_timestamp(now), rng.choice([900, 1800, 3600]))
+                written += 1
+            else:
+                command, titles = pick_application(rng)
+                for title in titles(rng):
+                    yield "%s -- %s ::: %s" % (format_timestamp(now), command, title)
+                    written += 1
+                    now += datetime.timedelta(seconds=rng.randint(0, 3))
+            now += datetime.timedelta(seconds=int(rng.expovariate(1/60.)))
+        yield "-- Closing log at %s --" % (format_timestamp(now))
+        written += 1
+        if now.hour < 15:
+            now += datetime.timedelta(minutes=rng.randint(15, 90))
+            continue
+        # Clock out for the day; submit every other Friday.
+        if now.weekday() == 4 and now.isocalendar()[1] % 2 == 0 and written < count:
+            yield "%s -- [Note] [submitted]" % (format_timestamp(now + datetime.timedelta(minutes=1)))
+            written += 1
+        now = datetime.datetime.combine(now.date(), datetime.time(9, rng.randint(0, 59)))
+        now += datetime.timedelta(days=3 if now.weekday() == 4 else 1)
+
+def write_log(path, count, seed=0):
+    with open(path, 'w') as f:
+        for line in generate_lines(count, seed):
+            print >>f, line
+
+#########
+# Timing
+
+def time_call(func, *args):
+    start = time.time()
+    result = func(*args)
+    return (time.time() - start, result)
+
+def best_of(repeat, func, *args):
+    """Time func repeat times; return (fastest, all times, last result)."""
+    times = []
+    for i in xrange(repeat):
+        elapsed, result = time_call(func, *args)
+        times.append(elapsed)
+    return (min(times), times, result)
+
+def quietly(func, *args):
+    """Call func with its printed output discarded."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def record(results, name, repeat, func, *args, **kwargs):
+    """Time func, print a line about it and add it to results."""
+    best, times, result = best_of(repeat, func, *args)
+    results[name] = dict(kwargs, seconds=best, runs=times)
+    print "%-40s %9.4f s" % (name, best)
+    return result
+
+def setup_timecard(logfile, checkpoint=False):
+    """Point the timecard module at logfile with the default config."""
+    timecard.logger = logging.getLogger('timecard')
+    loaded_path, config = timecard.load_config([], copy.deepcopy(timecard.default_config))
+    config['checkpoint'] = checkpoint
+    timecard.config = timecard.process_args(argparse.Namespace(logfile=logfile), config)
+
+def remove_checkpoint(logfile):
+    try:
+        os.remove(timelog.checkpoint_path(logfile))
+    except OSError:
+        pass
+
+def remove_rollup(logfile):
+    try:
+        os.remove(rollup.rollup_path(logfile))
+    except OSError:
+        pass
+
+#########
+# Suites
+
+def bench_timestamps(lines, results, repeat=1, limit=100000):
+    # dateutil takes minutes over a full log, so compare on a sample.
+    texts = [timelog.line_timestamp(line) for line in lines[:limit]]
+    expected = record(results, 'timestamps.dateutil', repeat, lambda: [dateparser.parse(t) for t in texts], items=len(texts))
+    parsed = record(results, 'timestamps.parse_timestamp', repeat, lambda: [timelog.parse_timestamp(t) for t in texts], items=len(texts))
+    if parsed != expected:
+        print >>sys.stderr, "parse_timestamp disagrees with dateutil!"
+        sys.exit(1)
+    print "Speedup: %.1fx" % (results['timestamps.dateutil']['seconds']/results['timestamps.parse_timestamp']['seconds'])
+
+def bench_spans(logfile, results, repeat=1):
+    spans, adjustments, last_paid = record(results, 'get_spans', repeat, lambda: timecard.get_spans(timelog.read_events(logfile)))
+    results['get_spans']['spans'] = len(spans)
+    # Hours per day for a year: every range against every span, or one sweep.
+    intervals = [(span[0][0], span[-1][0]) for span in spans]
+    first = datetime.datetime.combine(intervals[0][0].date(), datetime.time())
+    days = [first + datetime.timedelta(days=n) for n in xrange(366)]
+    def rescan():
+        return [sum(analysis.clipped(start, end, a, b) for start, end in intervals) for a, b in zip(days, days[1:])]
+    expected = record(results, 'coverage.days_rescan', repeat, rescan, ranges=len(days)-1)
+    swept = record(results, 'coverage.days_sweep', repeat, lambda: analysis.Coverage(intervals).between(days), ranges=len(days)-1)
+    if swept != expected:
+        print >>sys.stderr, "Coverage disagrees with clipping every span!"
+        sys.exit(1)
+
+def bench_summarize(logfile, results, repeat=1):
+    def Namespace(timerange=None, by=None):
+        return argparse.Namespace(timerange=timerange, by=by, projects=False, follow=False)
+    setup_timecard(logfile, checkpoint=False)
+    record(results, 'summarize', repeat, quietly, timecard.command_summarize, Namespace())
+    record(results, 'summarize.range', repeat, quietly, timecard.command_summarize, Namespace('lastpaid'))
+    # What summarize --follow does on each change, against re-running summarize.
+    state = timecard.follow_update(None)
+    def refresh():
+        timecard.follow_show('lastpaid', timecard.follow_update(state))
+    record(results, 'summarize.follow_refresh', repeat, quietly, refresh)
+    remove_rollup(logfile)
+    record(results, 'summarize.by_month_cold', 1, quietly, timecard.command_summarize, Namespace(by='month'))
+    record(results, 'summarize.by_month_warm', repeat, quietly, timecard.command_summarize, Namespace(by='month'))
+    record(results, 'summarize.by_week_range', repeat, quietly, timecard.command_summarize, Namespace('lastpaid', 'week'))
+    remove_rollup(logfile)
+    setup_timecard(logfile, checkpoint=True)
+    remove_checkpoint(logfile)
+    record(results, 'summarize.checkpoint_cold', 1, quietly, timecard.command_summarize, Namespace())
+    record(results, 'summarize.checkpoint_warm', repeat, quietly, timecard.command_summarize, Namespace())
+    remove_checkpoint(logfile)
+
+# Project rules matching the synthetic log's windows.
+projects = [
+    {'project': 'timecard', 'window': r'timecard\.py|project[0-3]\b'},
+    {'project': 'billing', 'command': '*libreoffice*', 'glob': True},
+    {'project': 'review', 'window': 'GitHub'},
+    {'project': 'admin', 'window': '*gmail*', 'glob': True}
+]
+
+def bench_analyze(logfile, results, repeat=1, jobs=1):
+    Namespace = argparse.Namespace
+    setup_timecard(logfile)
+    record(results, 'analyze', repeat, quietly, timecard.command_analyze, Namespace(timerange=None, jobs=1, top=None))
+    record(results, 'analyze.range', repeat, quietly, timecard.command_analyze, Namespace(timerange='lastpaid', jobs=1, top=None))
+    if jobs > 1:
+        record(results, 'analyze.jobs', repeat, quietly, timecard.command_analyze, Namespace(timerange=None, jobs=jobs, top=None), jobs=jobs)
+    timecard.config['projects'] = projects
+    record(results, 'analyze.projects', repeat, quietly, timecard.command_analyze, Namespace(timerange=None, jobs=1, top=None))
+    timecard.config['projects'] = False
+
+timeranges = ['today', 'lastpaid', '1w2d3h', '2w-1w', '1325494800-1326494800', 'Jan 1 2012']
+
+def bench_timerange(results, repeat=1, count=1000):
+    last_paid = datetime.datetime(2012, 1, 13, 17, 0, 0)
+    for timerange in timeranges:
+        record(results, 'parse_timerange.%s' % (timerange.replace(' ', '_')), repeat,
+               lambda: [timecard.parse_timerange(timerange, last_paid) for i in xrange(count)], items=count)
+
+# Capture sizes for each screenshot target: a dual-monitor desktop, one
+# monitor of it and a typical maximized-but-not-fullscreen window.
+screenshot_sizes = {
+    'all': (3840, 1080),
+    'active-monitor': (1920, 1080),
+    'cursor-monitor': (1920, 1080),
+    'active-window': (1600, 900)
+}
+
+def fake_pixbuf(width, height, seed=0):
+    """Build a desktop-like RGB pixbuf (flat panels, text-ish noise) in memory."""
+    from gi.repository import GLib, GdkPixbuf
+    rng = random.Random(seed)
+    rows = []
+    for y in xrange(height):
+        if y % 24 < 14:
+            # Lines of "text": noisy dark runs on a light background.
+            row = bytearray('\xf0\xf0\xf0' * width)
+            for x in xrange(rng.randint(0, width//8), rng.randint(width//2, width), 7):
+                row[3*x:3*x+3] = chr(rng.randint(0, 90)) * 3
+        else:
+            row = bytearray('\xf0\xf0\xf0' * width)
+        rows.append(str(row))
+    data = GLib.Bytes.new(''.join(rows))
+    return GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB, False, 8, width, height, width*3)
+
+def bench_screenshots(results, repeat=1, directory=None):
+    for name, target in sorted(timecard.screenshot_types.items()):
+        width, height = screenshot_sizes[name]
+        pb = fake_pixbuf(width, height)
+        filepath = os.path.join(directory, name)
+        for fmt in ('png', 'jpg'):
+            record(results, 'screenshot.%s.%s' % (name, fmt), repeat, screenshot.save_pixbuf, pb, filepath, fmt,
+                   target=target, width=width, height=height)
+        record(results, 'screenshot.%s.signature' % (name), repeat, screenshot.frame_signature, pb)
+
+# Commands run from hotkeys and scripts, where start-up time is most of
+# the wait; each should finish well under 100 ms.
+startup_commands = [
+    ['note', 'benchmark'],
+    ['manual', '15m'],
+    ['summarize'],
+    ['status']
+]
+
+def bench_startup(results, repeat=1, directory=None, lines=1000):
+    """Time whole timecard processes, against a small log and a config of their own."""
+    logfile = os.path.join(directory, 'startup.log')
+    write_log(logfile, lines)
+    configfile = os.path.join(directory, 'startup.conf')
+    with open(configfile, 'w') as f:
+        print >>f, "checkpoint: false"
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(directory, 'cache'))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'timecard.py')
+    devnull = open(os.devnull, 'w')
+    def run(argv):
+        subprocess.call(argv, stdout=devnull, stderr=devnull, env=env)
+    try:
+        record(results, 'startup.python', repeat, run, [sys.executable, '-c', 'pass'])
+        for command in startup_commands:
+            argv = [sys.executable, script, '-c', configfile, '-f', logfile] + command
+            # Once untimed, to fill the config cache.
+            run(argv)
+            record(results, 'startup.%s' % (command[0]), repeat, run, argv)
+    finally:
+        devnull.close()
+
+suites = ['timestamps', 'spans', 'summarize', 'analyze', 'timerange', 'startup', 'screenshots']
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark timecard log reporting and screenshot encoding.")
+    argparser.add_argument('-n', '--lines', type=int, default=1000000, help="Number of synthetic log lines.")
+    argparser.add_argument('-s', '--seed', type=int, default=0, help="Random seed for the synthetic log.")
+    argparser.add_argument('-r', '--repeat', type=int, default=3, help="Runs per benchmark; the fastest is reported.")
+    argparser.add_argument('-j', '--jobs', type=int, default=1, help="Also time analyze with this many processes.")
+    argparser.add_argument('-l', '--log', metavar='path', help="Benchmark an existing log instead of a synthetic one.")
+    argparser.add_argument('-o', '--output', metavar='path', default='benchmark.json', help="JSON file to write results to.")
+    argparser.add_argument('suites', nargs='*', metavar='suite', help="Benchmarks to run: %s. Defaults to all." % (', '.join(suites)))
+    args = argparser.parse_args()
+    for suite in args.suites:
+        if suite not in suites:
+            argparser.error("unknown suite %s" % (suite))
+    selected = args.suites or suites
+
+    directory = tempfile.mkdtemp(prefix='timecard-benchmark-')
+    try:
+        logfile = args.log
+        if not logfile:
+            logfile = os.path.join(directory, 'benchmark.log')
+            print "Writing %d synthetic log lines..." % (args.lines)
+            write_log(logfile, args.lines, args.seed)
+        setup_timecard(logfile)
+        results = {}
+        if 'timestamps' in selected:
+            with open(logfile, 'r') as f:
+                lines = f.readlines()
+            print "Parsing %d timestamps..." % (len(lines))
+            bench_timestamps(lines, results, args.repeat)
+        if 'spans' in selected:
+            bench_spans(logfile, results, args.repeat)
+        if 'summarize' in selected:
+            bench_summarize(logfile, results, args.repeat)
+        if 'analyze' in selected:
+            bench_analyze(logfile, results, args.repeat, args.jobs)
+        if 'timerange' in selected:
+            bench_timerange(results, args.repeat)
+        if 'startup' in selected:
+            bench_startup(results, max(args.repeat, 10), directory)
+        if 'screenshots' in selected:
+            bench_screenshots(results, args.repeat, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'log': args.log,
+        'lines': None if args.log else args.lines,
+        'seed': args.seed,
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print "Results written to %s." % (args.output)
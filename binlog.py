@@ -0,0 +1,354 @@
+"""binlog.py
+
+Compact binary timecard log format.
+
+A binary log starts with timelog.BINARY_MAGIC, followed by fixed-width
+records of (timestamp, kind, command, window). Commands and window titles
+are stored once each in the append-only <log>.commands and <log>.windows
+string tables, and records refer to them by index. Note text is kept in
+the window table and manual adjustment seconds in the command field.
+
+Lines that can't be reproduced exactly from a parsed Event are stored
+verbatim as RAW records, so conversion to and from text is lossless.
+"""
+
+import os
+import struct
+import timelog
+
+MAGIC = timelog.BINARY_MAGIC
+HEADER_SIZE = len(MAGIC)
+RECORD = struct.Struct('<qB3xii') # timestamp, kind, command, window
+STRING = struct.Struct('<I') # length prefix of a string table entry
+
+RAW = 6 # Verbatim text line, kept in the window table
+
+is_binary = timelog.is_binary
+
+def table_path(path, table):
+    return '%s.%s' % (path, table)
+
+def read_table(path):
+    """Load a string table, ignoring a torn entry at the end."""
+    strings = []
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return strings
+    with f:
+        while True:
+            header = f.read(STRING.size)
+            if len(header) < STRING.size:
+                break
+            length = STRING.unpack(header)[0]
+            data = f.read(length)
+            if len(data) < length:
+                break
+            strings.append(data)
+    return strings
+
+class BinaryLogWriter(object):
+    """Appends text log lines to a binary log.
+
+    Has the same append/flush/close interface as timelog.LogWriter. New
+    strings are flushed to their table before any record that uses them.
+    """
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new and not is_binary(path):
+            raise ValueError, "%s is not a binary log" % (path,)
+        self.f = open(path, 'ab')
+        if new:
+            self.f.write(MAGIC)
+        self.tables = {}
+        for table in ('commands', 'windows'):
+            strings = read_table(table_path(path, table))
+            self.tables[table] = (open(table_path(path, table), 'ab'), dict((s, i) for i, s in enumerate(strings)))
+        self.last_timestamp = 0
+        if not new:
+            count = (complete_length(path) - HEADER_SIZE) // RECORD.size
+            if count:
+                with open(path, 'rb') as f:
+                    f.seek(HEADER_SIZE + (count-1)*RECORD.size)
+                    self.last_timestamp = RECORD.unpack(f.read(RECORD.size))[0]
+
+    def _intern(self, table, string):
+        f, codes = self.tables[table]
+        code = codes.get(string)
+        if code is None:
+            code = codes[string] = len(codes)
+            f.write(STRING.pack(len(string)) + string)
+            f.flush()
+        return code
+
+    def append(self, line):
+        if self.moved():
+            self._reopen()
+        line = line.rstrip('\n')
+        try:
+            event = timelog.parse_line(line.strip())
+        except (ValueError, OverflowError):
+            event = None
+        if event is not None:
+            self.last_timestamp = timelog.to_epoch(event.timestamp)
+        if event is None or timelog.format_event(event) != line:
+            # Keep the previous timestamp so records stay sorted for bisection.
+            self.f.write(RECORD.pack(self.last_timestamp, RAW, -1, self._intern('windows', line)))
+            return
+        command, window = -1, -1
+        if event.kind == timelog.WINDOW:
+            command = self._intern('commands', event.command)
+            window = self._intern('windows', event.window)
+        elif event.kind in (timelog.NOTE, timelog.SUBMITTED):
+            window = self._intern('windows', event.value)
+        elif event.kind == timelog.MANUAL:
+            command = event.value
+        self.f.write(RECORD.pack(self.last_timestamp, event.kind, command, window))
+
+    def flush(self):
+        self.f.flush()
+        if self.moved():
+            self._reopen()
+
+    def moved(self):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.f.fileno()).st_ino
+        except OSError:
+            return True
+
+    def _reopen(self):
+        # Rolled into a segment; what is written from now on belongs to a
+        # new log and tables at the same path.
+        self.close()
+        self.__init__(self.path)
+
+    def close(self):
+        self.f.close()
+        for f, codes in self.tables.values():
+            f.close()
+
+def complete_length(path):
+    """Return the offset just past the last complete record in path."""
+    size = os.path.getsize(path)
+    if size < HEADER_SIZE:
+        return size
+    return HEADER_SIZE + (size - HEADER_SIZE) // RECORD.size * RECORD.size
+
+def read_records(path, start=0, end=None, batch=4096):
+    """Yield raw (timestamp, kind, command, window) records between byte offsets."""
+    start = max(start, HEADER_SIZE)
+    end = complete_length(path) if end is None else min(end, complete_length(path))
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            data = f.read(min(batch*RECORD.size, end - position))
+            if not data:
+                break
+            for offset in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+                yield RECORD.unpack_from(data, offset)
+            position += len(data)
+
+def _to_event(record, commands, windows):
+    """Build the Event stored in a record other than RAW."""
+    timestamp, kind, command, window = record
+    timestamp = timelog.from_epoch(timestamp)
+    if kind == timelog.WINDOW:
+        return timelog.Event(timestamp, kind, commands[command], windows[window], None)
+    elif kind in (timelog.NOTE, timelog.SUBMITTED):
+        return timelog.Event(timestamp, kind, None, None, windows[window])
+    elif kind == timelog.MANUAL:
+        return timelog.Event(timestamp, kind, None, None, command)
+    else:
+        return timelog.Event(timestamp, kind, None, None, None)
+
+def read_events(path, start=0, end=None):
+    """Stream Events from a binary log, as timelog.read_events() does for text."""
+    commands = read_table(table_path(path, 'commands'))
+    windows = read_table(table_path(path, 'windows'))
+    for record in read_records(path, start, end):
+        if record[1] == RAW:
+            event = timelog.parse_line(windows[record[3]].strip())
+            if event is not None:
+                yield event
+        else:
+            yield _to_event(record, commands, windows)
+
+def iter_lines(path):
+    """Yield the text log lines stored in a binary log."""
+    commands = read_table(table_path(path, 'commands'))
+    windows = read_table(table_path(path, 'windows'))
+    for record in read_records(path):
+        if record[1] == RAW:
+            yield windows[record[3]]
+        else:
+            yield timelog.format_event(_to_event(record, commands, windows))
+
+def to_text(source, destination):
+    """Convert a binary log into a text log. Returns the number of lines."""
+    count = 0
+    with open(destination, 'w') as f:
+        for line in iter_lines(source):
+            print >>f, line
+            count += 1
+    return count
+
+def to_binary(source, destination):
+    """Convert a text log into a binary log. Returns the number of lines."""
+    count = 0
+    writer = BinaryLogWriter(destination)
+    try:
+        with open(source, 'r') as f:
+            for line in f:
+                writer.append(line)
+                count += 1
+    finally:
+        writer.close()
+    return count
+
+#########
+# Time range seeks
+
+class _Records(object):
+    """Random access to the records of a binary log."""
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.count = (complete_length(path) - HEADER_SIZE) // RECORD.size if os.path.getsize(path) >= HEADER_SIZE else 0
+
+    def __getitem__(self, i):
+        self.f.seek(HEADER_SIZE + i*RECORD.size)
+        return RECORD.unpack(self.f.read(RECORD.size))
+
+    def bisect(self, timestamp, after=False):
+        """Index of the first record stamped at (or, with after, past) timestamp."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self[mid][0]
+            if found > timestamp or (found == timestamp and not after):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def close(self):
+        self.f.close()
+
+def _offset(i):
+    return HEADER_SIZE + i*RECORD.size
+
+def range_offsets(path, start_time, end_time):
+    """Binary log version of timelog.range_offsets()."""
+    records = _Records(path)
+    try:
+        start = records.bisect(timelog.to_epoch(start_time))
+        for i in xrange(start - 1, -1, -1):
+            kind = records[i][1]
+            if kind == timelog.CLOSE:
+                break
+            elif kind == timelog.START:
+                start = i
+                break
+        end = records.bisect(timelog.to_epoch(end_time), after=True)
+        while end < records.count:
+            kind = records[end][1]
+            if kind == timelog.CLOSE:
+                end += 1
+                break
+            elif kind == timelog.START:
+                break
+            end += 1
+        return (_offset(start), _offset(end))
+    finally:
+        records.close()
+
+def split_offsets(path, count, start=0, end=None):
+    """Binary log version of timelog.split_offsets()."""
+    records = _Records(path)
+    try:
+        first = (max(start, HEADER_SIZE) - HEADER_SIZE) // RECORD.size
+        last = records.count if end is None else (end - HEADER_SIZE) // RECORD.size
+        shards = []
+        begin = first
+        for n in xrange(1, count):
+            cut = first + (last - first) * n // count
+            while cut < last and records[cut][1] != timelog.START:
+                cut += 1
+            if cut >= last:
+                break
+            if cut > begin:
+                shards.append((_offset(begin), _offset(cut)))
+                begin = cut
+        shards.append((_offset(begin), _offset(last)))
+        return shards
+    finally:
+        records.close()
+
+def find_last_paid(path):
+    """Binary log version of timelog.find_last_paid()."""
+    windows = None
+    for timestamp, kind, command, window in _reversed_records(path):
+        if kind == timelog.SUBMITTED:
+            return timelog.from_epoch(timestamp)
+        elif kind == RAW:
+            if windows is None:
+                windows = read_table(table_path(path, 'windows'))
+            event = timelog.parse_line(windows[window].strip())
+            if event is not None and event.kind == timelog.SUBMITTED:
+                return event.timestamp
+    return None
+
+def _reversed_records(path, batch=4096):
+    end = complete_length(path)
+    with open(path, 'rb') as f:
+        while end > HEADER_SIZE:
+            start = max(HEADER_SIZE, end - batch*RECORD.size)
+            f.seek(start)
+            data = f.read(end - start)
+            for offset in xrange(len(data) - RECORD.size, -1, -RECORD.size):
+                yield RECORD.unpack_from(data, offset)
+            end = start
+
+
+if __name__ == "__main__":
+    # Tests: a submit that rolls a binary log, as the running timecard does
+    # it, then a summary across the roll.
+    import sys
+    import copy
+    import shutil
+    import logging
+    import argparse
+    import tempfile
+    import timecard
+    import segments
+    
+    directory = tempfile.mkdtemp(prefix='timecard-binlog-')
+    try:
+        logfile = os.path.join(directory, 'test.log')
+        timecard.logger = logging.getLogger('timecard')
+        loaded_path, config = timecard.load_config([], copy.deepcopy(timecard.default_config))
+        config.update(storage='binary', checkpoint=False, segments={'max_size': None})
+        timecard.config = timecard.process_args(argparse.Namespace(logfile=logfile), config)
+        timecard.log_writer = timecard.open_log_writer()
+        timecard.start_log()
+        timecard.monitor('/usr/bin/vim', 'before.txt')
+        timecard.control_submit({})
+        timecard.monitor('/usr/bin/vim', 'after.txt')
+        timecard.close_log()
+        timecard.log_writer.close()
+        
+        kinds = lambda path: [event.kind for event in read_events(path)]
+        entry, = segments.load_manifest(logfile)['segments']
+        segment = segments.segment_file(logfile, entry)
+        assert kinds(segment) == [timelog.START, timelog.WINDOW, timelog.CLOSE, timelog.SUBMITTED], kinds(segment)
+        assert kinds(logfile) == [timelog.START, timelog.WINDOW, timelog.WINDOW, timelog.CLOSE], kinds(logfile)
+        assert [event.window for event in read_events(logfile)][1:3] == ['before.txt', 'after.txt']
+        # The manifest describes exactly the spans left in the segment.
+        spans, adjustments, last_paid = timecard.get_spans(read_events(segment))
+        assert entry['spans'] == [[timelog.to_epoch(s[0].timestamp), timelog.to_epoch(s[-1].timestamp), 1] for s in spans]
+        spans, adjustments, start_time, end_time = timecard.collect_spans()
+        assert len(spans) == 2 and all(span[0].kind == timelog.START and span[-1].kind == timelog.CLOSE for span in spans), spans
+    finally:
+        shutil.rmtree(directory)
+    print "All tests passed."
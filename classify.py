@@ -0,0 +1,108 @@
+"""classify.py
+
+Classification of logged windows into the projects time is billed to.
+
+Rules come from the projects list of the timecard config, and the first
+matching rule decides:
+
+    projects:
+      - project: acme/website
+        window: 'acme\\.com|wp-admin'
+      - project: acme/hosting
+        command: '*filezilla*'
+        glob: true
+
+command and window are regular expressions searched for in the process
+command line and the window title, or with glob set, shell-style patterns
+matching all of it. Both are case-insensitive, and a rule without one
+matches anything there. Windows matching no rule are UNCLASSIFIED.
+"""
+
+import re
+import fnmatch
+import datetime
+import collections
+
+UNCLASSIFIED = '(unclassified)'
+CACHE_SIZE = 65536
+
+class Rule(object):
+    """A project and the patterns a window's command and title must match."""
+    def __init__(self, project, command=None, window=None, glob=False):
+        if not project:
+            raise ValueError, "rule without a project"
+        if command is None and window is None:
+            raise ValueError, "rule for %s matches nothing; give it a command or window pattern" % (project,)
+        self.project = project
+        self.command = self._compile(command, glob)
+        self.window = self._compile(window, glob)
+
+    def _compile(self, pattern, glob):
+        if pattern is None:
+            return None
+        try:
+            return re.compile(fnmatch.translate(pattern) if glob else pattern, re.IGNORECASE)
+        except re.error as e:
+            raise ValueError, "bad pattern %r for %s: %s" % (pattern, self.project, e)
+
+    def matches(self, command, window):
+        if self.command is not None and not self.command.search(command or ''):
+            return False
+        if self.window is not None and not self.window.search(window or ''):
+            return False
+        return True
+
+class Classifier(object):
+    """Maps (command, window) pairs to projects by the first matching rule.
+
+    Results are cached per pair in an LRU of at most cache_size entries, so
+    the rules only run once for each distinct window of a busy log.
+    """
+    def __init__(self, rules, cache_size=CACHE_SIZE):
+        self.rules = rules
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, projects, cache_size=CACHE_SIZE):
+        """Build a classifier from the projects list of the config.
+
+        Raises ValueError for a malformed rule.
+        """
+        rules = []
+        for n, rule in enumerate(projects or []):
+            if not isinstance(rule, dict):
+                raise ValueError, "project rule %d is not a mapping" % (n+1,)
+            unknown = set(rule) - set(('project', 'command', 'window', 'glob'))
+            if unknown:
+                raise ValueError, "project rule %d has unknown keys %s" % (n+1, ', '.join(sorted(unknown)))
+            rules.append(Rule(rule.get('project'), rule.get('command'), rule.get('window'), rule.get('glob', False)))
+        return cls(rules, cache_size)
+
+    def classify(self, command, window):
+        key = (command, window)
+        try:
+            project = self.cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            project = UNCLASSIFIED
+            for rule in self.rules:
+                if rule.matches(command, window):
+                    project = rule.project
+                    break
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        # Most recently used last.
+        self.cache[key] = project
+        return project
+
+    def totals(self, pair_histogram):
+        """Sum a histogram keyed by (command, window) into one keyed by project."""
+        projects = {}
+        for (command, window), elapsed in pair_histogram.iteritems():
+            project = self.classify(command, window)
+            projects[project] = projects.get(project, datetime.timedelta(0)) + elapsed
+        return projects
@@ -0,0 +1,110 @@
+"""control.py
+
+Unix socket control channel of a running timecard.
+
+Each connection carries one request, a JSON object on a single line with
+a "command" key, and gets one JSON reply line back with "ok" set, plus
+"error" when it failed. Requests are handled on the daemon's main loop,
+so everything they write goes through the daemon's own log writer.
+"""
+
+import os
+import json
+import errno
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_REQUEST = 16 << 20 # archive requests carry a segment's manifest entry
+
+class ControlServer(object):
+    """Listens on a Unix socket and dispatches requests to handlers.
+
+    handlers maps command names to functions taking the request dict and
+    returning a dict of reply fields (or None). The socket is non-blocking;
+    call handle() when it is readable, e.g. from a GLib IO watch on fileno().
+    """
+    def __init__(self, path, handlers):
+        self.path = path
+        self.handlers = handlers
+        try:
+            # Left behind by a timecard that didn't shut down cleanly.
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0600)
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle(self, *args):
+        try:
+            conn, address = self.sock.accept()
+        except socket.error:
+            return True
+        try:
+            conn.settimeout(1)
+            chunks = []
+            size = 0
+            while size < MAX_REQUEST:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+                if '\n' in chunk:
+                    break
+            data = ''.join(chunks)
+            conn.sendall(json.dumps(self.dispatch(data)) + '\n')
+        except socket.error as e:
+            logger.debug("Control request failed: %s" % (e,))
+        finally:
+            conn.close()
+        return True
+
+    def dispatch(self, data):
+        try:
+            request = json.loads(data)
+            handler = self.handlers[request['command']]
+        except (ValueError, KeyError, TypeError):
+            return {'ok': False, 'error': "bad request %r" % (data.strip()[:100],)}
+        logger.debug("Control request: %s" % (request,))
+        try:
+            reply = handler(request) or {}
+        except Exception as e:
+            logger.debug("Control command %s failed: %s" % (request['command'], e))
+            return {'ok': False, 'error': str(e)}
+        return dict(reply, ok=True)
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def request(path, command, timeout=5, **fields):
+    """Send a command to the timecard listening at path and return its reply.
+
+    Raises socket.error if nothing is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(dict(fields, command=command)) + '\n')
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        sock.close()
+    return json.loads(''.join(data))
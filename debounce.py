@@ -0,0 +1,149 @@
+"""debounce.py
+
+Coalescing of rapid window title changes before they are logged.
+"""
+
+import time
+import stats
+
+class TitleDebouncer(object):
+    """Holds back window title changes until they have settled.
+
+    A title is only logged once no other change has arrived for settle
+    seconds, so a burst of changes is logged as its final title, stamped
+    with the time that title appeared. Repeats of the last logged title are
+    dropped, and each process may log at most rate titles a minute; beyond
+    that its changes are coalesced until the limit allows another.
+
+    write(command, title, timestamp) does the logging. schedule(delay,
+    callback) must call callback after delay seconds, e.g. through
+    GLib.timeout_add.
+    """
+    def __init__(self, write, schedule, settle=1.0, rate=30, clock=time.time):
+        self.write = write
+        self.schedule = schedule
+        self.settle = settle
+        self.rate = rate
+        self.clock = clock
+        # (arrival, pid, command, title, timestamp) waiting to be logged
+        self.pending = None
+        # (command, title) logged last
+        self.last = None
+        self.timer = False
+        # pid -> (tokens, updated)
+        self.buckets = {}
+
+    def submit(self, pid, command, title, timestamp):
+        now = self.clock()
+        if self.pending is not None:
+            if self._wait(now) <= 0:
+                self._commit()
+            else:
+                stats.count('titles.coalesced')
+                self.pending = None
+        if (command, title) == self.last:
+            stats.count('titles.repeats')
+            return
+        self.pending = (now, pid, command, title, timestamp)
+        wait = self._wait(now)
+        if wait <= 0:
+            self._commit()
+        else:
+            self._arm(wait)
+
+    def flush(self):
+        """Log the pending title now, regardless of settle time and rate limits."""
+        if self.pending is not None:
+            self._commit()
+
+    def reset(self):
+        """Forget the last logged title, e.g. after the log was closed and reopened."""
+        self.flush()
+        self.last = None
+
+    def forget(self, pid):
+        """Drop the rate limit state of a process that has exited."""
+        self.buckets.pop(pid, None)
+
+    def _tokens(self, pid, now):
+        tokens, updated = self.buckets.get(pid, (self.rate, now))
+        return min(self.rate, tokens + (now - updated) * self.rate / 60.)
+
+    def _wait(self, now):
+        """Seconds until the pending title may be logged."""
+        arrival, pid = self.pending[:2]
+        wait = self.settle - (now - arrival)
+        if self.rate:
+            wait = max(wait, (1 - self._tokens(pid, now)) * 60. / self.rate)
+        return wait
+
+    def _arm(self, delay):
+        if not self.timer:
+            self.timer = True
+            self.schedule(delay, self._fire)
+
+    def _fire(self):
+        self.timer = False
+        if self.pending is not None:
+            wait = self._wait(self.clock())
+            if wait <= 0:
+                self._commit()
+            else:
+                self._arm(wait)
+        return False
+
+    def _commit(self):
+        arrival, pid, command, title, timestamp = self.pending
+        self.pending = None
+        if self.rate:
+            now = self.clock()
+            self.buckets[pid] = (max(0, self._tokens(pid, now) - 1), now)
+        self.last = (command, title)
+        self.write(command, title, timestamp)
+
+
+if __name__ == "__main__":
+    # Tests: a burst of titles is logged as its last one, repeats of the
+    # logged title are dropped, and a process over its rate has its titles
+    # coalesced until the limit allows another.
+    now = [0.0]
+    logged = []
+    timers = []
+    def schedule(delay, callback):
+        timers.append((now[0] + delay, callback))
+        timers.sort()
+    def advance(seconds):
+        now[0] += seconds
+        while timers and timers[0][0] <= now[0]:
+            timers.pop(0)[1]()
+    debouncer = TitleDebouncer(lambda command, title, timestamp: logged.append((title, timestamp)), schedule, 1, 30, clock=lambda: now[0])
+    debouncer.submit(1, 'vim', 'a', 0)
+    advance(0.5)
+    debouncer.submit(1, 'vim', 'b', 0.5)
+    advance(0.5)
+    debouncer.submit(1, 'vim', 'c', 1)
+    advance(0.9)
+    assert logged == [], logged
+    advance(0.1)
+    assert logged == [('c', 1)], logged
+    
+    debouncer.submit(1, 'vim', 'c', 3)
+    advance(2)
+    debouncer.submit(1, 'vim', 'd', 5)
+    advance(0.5)
+    debouncer.submit(1, 'vim', 'c', 5.5)
+    advance(2)
+    assert logged == [('c', 1)], logged
+    
+    del logged[:]
+    debouncer = TitleDebouncer(lambda command, title, timestamp: logged.append((title, timestamp)), schedule, 0, 30, clock=lambda: now[0])
+    for i in xrange(30):
+        debouncer.submit(1, 'vim', str(i), now[0])
+    assert len(logged) == 30, logged
+    debouncer.submit(1, 'vim', 'over', now[0])
+    advance(1)
+    debouncer.submit(1, 'vim', 'still over', now[0])
+    assert len(logged) == 30, logged
+    advance(1)
+    assert logged[30:] == [('still over', now[0] - 1)], logged[30:]
+    print "All tests passed."
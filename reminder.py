@@ -1,41 +1,44 @@
+"""reminder.py
+
+Reminds you to clock in when the active window looks like work.
+
+Run from cron, it checks the active window once. With --watch it stays
+resident instead, following active window and title changes through Wnck
+and watching the timecard's lock file, so the prompt comes as soon as a
+work window is focused without any polling.
+"""
+
 import os
+import re
 import sys
 import datetime
-import Xlib.display, Xlib.error
+import argparse
+import logging
 import subprocess
-import pynotify
-import gtk
-import glib
+import timecard
 
 ignore_filepath = "/tmp/timecard-reminder.ignore"
 ignore_time = datetime.timedelta(hours=1)
 
-def find_display(max_n=9):
-    display_name = ""
-    test_count = 0
-    while display_name == "":
-        test_name = ":%d.0" % (test_count)
-        try:
-            display_name = Xlib.display.Display(test_name).display.display_name
-        except Xlib.error.DisplayConnectionError:
-            if test_count > max_n:
-                return None
-            test_count += 1
-            continue
-    return display_name
-
-def get_active_window():
-    window_id = subprocess.check_output(['xprop', '-root', '-f', '_NET_ACTIVE_WINDOW', '0x', r' $0\n', '_NET_ACTIVE_WINDOW']).split()[1]
-    window_title = ' '.join(subprocess.check_output(['xprop', '-id', str(window_id), '-f', '_NET_WM_NAME', '0s', r' $0\n', '_NET_WM_NAME']).split()[1:]).strip('"')
-    return window_title
-
-def get_current_timestamp(compact=False):
-    return format_timestamp(datetime.datetime.now(), compact=compact)
-
-def write_note(filename, note):
-    f = open(filename, 'a')
-    print >>f, "%s: [Note] %s" % (get_current_timestamp(), note)
-    f.close()
+# Overridden by the reminder section of the timecard config.
+default_settings = {
+    'keywords': ['THERMS', 'cPanel', 'Parallels', '.php', 'phpmyadmin', 'WebHost', 'PHP:', 'Write: ', 'deploy', 'webserver', 'name server', 'DNS'],
+    'repeat': 600 # seconds between prompts while watching
+}
+
+Gtk = GLib = Gio = Wnck = Notify = None
+
+def import_gui():
+    global Gtk, GLib, Gio, Wnck, Notify
+    from gi.repository import Gtk, GLib, Gio, Wnck, Notify
+
+def compile_keywords(keywords):
+    """Build one case-insensitive pattern matching titles containing any of keywords."""
+    if not keywords:
+        return re.compile(r'(?!)')
+    # Longest first, so a keyword that is a prefix of another doesn't hide it.
+    alternatives = sorted(set(keywords), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(k) for k in alternatives), re.IGNORECASE)
 
 def check_ignore():
     if not os.path.exists(ignore_filepath):
@@ -45,56 +48,129 @@ def check_ignore():
     return date > (datetime.datetime.now() - ignore_time)
 
 def set_ignore_file(notification=None, action=None, data=None):
-    #print notification, action, data
     f = open(ignore_filepath, 'w')
     d = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-    #print d
     print >>f, d
     f.close()
     notification.close()
-    gtk.main_quit()
 
 def noop(notification=None, action=None, data=None):
     notification.close()
-    gtk.main_quit()
 
+matcher = None
+lockfile = None
+resident = False
+repeat_time = None
+notification = None
+last_prompt = None
+# (window, handler id) of the name-changed signal being followed
+watched = (None, None)
 
-keywords = ['THERMS', 'cPanel', 'Parallels', '.php', 'phpmyadmin', 'WebHost', 'PHP:', 'Write: ', 'deploy', 'webserver', 'name server', 'DNS']
-base_dir = '/home/restorer/Documents/devel/timecard'
+def timecard_running():
+    return timecard.get_lock(lockfile) is not None
 
-if __name__ == '__main__':
+def prompt():
+    global notification
+    notification = Notify.Notification.new("Timecard", "You look like you're working - should start recording this stuff.", 'dialog-information')
+    notification.set_timeout(Notify.EXPIRES_DEFAULT)
+    notification.add_action("okay", "Okay", noop, None)
+    notification.add_action("ignore", "Ignore", set_ignore_file, None)
+    notification.connect("closed", prompt_closed)
+    notification.show()
+    try:
+        subprocess.call('beep -f 1350 -r 2 -d 35 -l 90'.split())
+    except OSError:
+        pass
+
+def prompt_closed(n):
+    global notification
+    notification = None
+    if not resident:
+        Gtk.main_quit()
+
+def check_title(title):
+    """Prompt if title looks like work and the timecard isn't running."""
+    global last_prompt
+    if not title or not matcher.search(title):
+        return False
+    if notification is not None or check_ignore() or timecard_running():
+        return False
+    now = datetime.datetime.now()
+    if last_prompt is not None and now - last_prompt < repeat_time:
+        return False
+    last_prompt = now
+    prompt()
+    return True
+
+def name_changed(window):
+    check_title(window.get_name())
+
+def focus_changed(screen, previous):
+    global watched
+    window, handler = watched
+    if window is not None:
+        window.disconnect(handler)
+    watched = (None, None)
+    window = screen.get_active_window()
+    if window is None:
+        return
+    # Follow title changes too, e.g. switching browser tabs.
+    watched = (window, window.connect("name-changed", name_changed))
+    check_title(window.get_name())
+
+def lock_changed(monitor, f, other, event):
+    # Clocked in while the prompt was up.
+    if notification is not None and timecard_running():
+        notification.close()
+
+def watch():
+    """Stay resident, checking every active window change."""
+    global resident
+    resident = True
+    screen = Wnck.Screen.get_default()
+    screen.connect("active-window-changed", focus_changed)
+    lock_monitor = Gio.File.new_for_path(lockfile).monitor_file(Gio.FileMonitorFlags.NONE, None)
+    lock_monitor.connect("changed", lock_changed)
+    Gtk.main()
+
+def check_once():
+    """Check the current active window, waiting on the prompt if one is shown."""
     if check_ignore():
-        sys.exit(0)
-    
+        return
+    screen = Wnck.Screen.get_default()
+    screen.force_update()
+    window = screen.get_active_window()
+    if window is not None and check_title(window.get_name()):
+        GLib.timeout_add_seconds(10, Gtk.main_quit)
+        Gtk.main()
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description="Remind you to clock in when you look like you're working.")
+    argparser.add_argument('-c', '--config-file', metavar='path', dest='configfile', help="Use the specified timecard config file location.")
+    argparser.add_argument('-f', '--file', metavar='path', dest='logfile', help="Time log file of the timecard to check. Defaults to the configured one.")
+    argparser.add_argument('-w', '--watch', action='store_true', help="Stay resident and check on every window change, instead of checking once.")
+    args = argparser.parse_args()
+
+    timecard.logger = logging.getLogger('timecard')
+    config_paths = timecard.config_paths
+    if args.configfile != None:
+        config_paths = [args.configfile] + config_paths
+    config_path, config = timecard.load_config(config_paths)
+    settings = dict(default_settings, **(config.get('reminder') or {}))
+
+    matcher = compile_keywords(settings['keywords'])
+    repeat_time = datetime.timedelta(seconds=settings['repeat'])
+    config = timecard.process_args(argparse.Namespace(logfile=args.logfile or config['logfile']), config)
+    lockfile = config['lockfile']
+
     # If called from cron, find first display.
     if not 'DISPLAY' in os.environ:
-        os.environ['DISPLAY'] = find_display()
-    
-    title = get_active_window()
-    working = False
-    for w in keywords:
-        if w.lower() in title.lower():
-            working = True
-    
-    os.chdir(base_dir)
-    
-    logname = None
-    for filename in os.listdir('/tmp'):
-        if filename.endswith('.lock'):
-            logname = filename
-    
-    if working and not logname:
-        if not pynotify.init("Timecard"):
-	        sys.exit(1)
-
-        n = pynotify.Notification("Timecard", "You look like you're working - should start recording this stuff.")
-        n.set_timeout(pynotify.EXPIRES_DEFAULT)
-        n.add_action("okay", "Okay", noop, None)
-        n.add_action("ignore", "Ignore", set_ignore_file, None)
-        n.show()
-        
-        glib.timeout_add_seconds(10, gtk.main_quit)
-        
-        subprocess.call('beep -f 1350 -r 2 -d 35 -l 90'.split())
-        
-        gtk.main()
+        os.environ['DISPLAY'] = timecard.find_display()
+
+    import_gui()
+    if not Notify.init("Timecard"):
+        sys.exit(1)
+    if args.watch:
+        watch()
+    else:
+        check_once()
@@ -0,0 +1,319 @@
+"""rollup.py
+
+Per-day totals of a timecard log, brought up to date by each report.
+
+The rollup of a log is kept in <log>.rollup as JSON. It maps each day
+("YYYY-MM-DD") to a record of the seconds worked in it, also split into
+24 hourly totals, the seconds of manual adjustments made in it, the number
+of spans started in it and the seconds spent in each command. Spans are
+split exactly at hour and day boundaries, so reports over whole days can
+be added up from the records without reading the log.
+
+Only closed spans are counted. Each update reads on from where the last
+one stopped. If the log was rolled or archived since, the segment it
+became is read on from the same offset instead. Only a log rewritten
+otherwise is read again from the start, skipping the spans and
+adjustments up to the last ones already counted.
+"""
+
+import os
+import json
+import hashlib
+import datetime
+import timelog
+import analysis
+
+ROLLUP_VERSION = 3
+
+def rollup_path(path):
+    return path + '.rollup'
+
+def new_day():
+    return {'seconds': 0, 'hours': [0] * 24, 'adjustments': 0, 'spans': 0, 'commands': {}}
+
+def _day(days, timestamp):
+    key = timestamp.strftime("%Y-%m-%d")
+    day = days.get(key)
+    if day is None:
+        day = days[key] = new_day()
+    return day
+
+def _add_interval(days, start, end, command=None):
+    """Add [start, end) to the days it covers, split at hour boundaries.
+
+    Adds to the worked time, or to command's time if it is given.
+    """
+    while start < end:
+        stop = min(end, start.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1))
+        seconds = int((stop - start).total_seconds())
+        day = _day(days, start)
+        if command is None:
+            day['seconds'] += seconds
+            day['hours'][start.hour] += seconds
+        else:
+            day['commands'][command] = day['commands'].get(command, 0) + seconds
+        start = stop
+
+def _later(a, b):
+    return b if a is None or b > a else a
+
+def accumulate(events, start_time=None, end_time=None, after=None, adjusted=None):
+    """Day records of the spans, adjustments and window events in events.
+
+    Spans last from their first to their last event, as in summarize, and
+    window events until the next window or close event of their span, as
+    in analyze. With a time range, everything is clipped to it. Spans
+    starting before after and adjustments made at or before adjusted are
+    skipped, as already counted.
+
+    Returns (days, timestamp of the last span event counted, timestamp of
+    the last adjustment counted).
+    """
+    days = {}
+    last = None
+    last_adjustment = None
+    span = None # [start, end] of the span being read
+    window = None # (timestamp, command) of the window being timed
+    def clip(start, end):
+        if start_time is not None:
+            start, end = max(start, start_time), min(end, end_time)
+        return (start, end)
+    def close_span():
+        if span is not None:
+            _add_interval(days, *clip(*span))
+    for event in events:
+        if event.kind == timelog.START:
+            close_span()
+            if after is not None and event.timestamp < after:
+                span = window = None
+                continue
+            span = [event.timestamp, event.timestamp]
+            window = None
+            last = _later(last, event.timestamp)
+            if start_time is None or start_time <= event.timestamp < end_time:
+                _day(days, event.timestamp)['spans'] += 1
+        elif event.kind == timelog.MANUAL:
+            if (adjusted is None or event.timestamp > adjusted) and (start_time is None or start_time <= event.timestamp < end_time):
+                _day(days, event.timestamp)['adjustments'] += event.value
+                last_adjustment = _later(last_adjustment, event.timestamp)
+        if span is None or event.kind == timelog.START:
+            continue
+        span[1] = event.timestamp
+        last = _later(last, event.timestamp)
+        if event.kind in (timelog.WINDOW, timelog.CLOSE):
+            if window is not None:
+                _add_interval(days, *clip(window[0], event.timestamp), command=window[1])
+            window = (event.timestamp, event.command) if event.kind == timelog.WINDOW else None
+        if event.kind == timelog.CLOSE:
+            close_span()
+            span = None
+    close_span()
+    return (days, last, last_adjustment)
+
+def add(day, record):
+    """Add one day record into another."""
+    day['seconds'] += record['seconds']
+    day['hours'] = [a + b for a, b in zip(day['hours'], record['hours'])]
+    day['adjustments'] += record['adjustments']
+    day['spans'] += record['spans']
+    for command, seconds in record['commands'].iteritems():
+        day['commands'][command] = day['commands'].get(command, 0) + seconds
+    return day
+
+def merge(days, other):
+    """Add the day records in other into days."""
+    for key, record in other.iteritems():
+        add(days.setdefault(key, new_day()), record)
+    return days
+
+def span_days(spans, adjustments, start_time=None, end_time=None):
+    """Day records of the time worked per hour, from spans and adjustments alone.
+
+    For logs without a rollup; the commands of the records stay empty.
+    """
+    days = {}
+    if spans:
+        coverage = analysis.Coverage((span[0][0], span[-1][0]) for span in spans)
+        first = start_time if start_time is not None else spans[0][0][0]
+        last = end_time if end_time is not None else max(span[-1][0] for span in spans)
+        boundaries = [first]
+        hour = first.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        while hour < last:
+            boundaries.append(hour)
+            hour += datetime.timedelta(hours=1)
+        boundaries.append(last)
+        for moment, seconds in zip(boundaries, coverage.between(boundaries)):
+            if seconds:
+                day = _day(days, moment)
+                day['seconds'] += seconds
+                day['hours'][moment.hour] += seconds
+    for span in spans:
+        if start_time is None or start_time <= span[0][0] < end_time:
+            _day(days, span[0][0])['spans'] += 1
+    for timestamp, value in adjustments:
+        if start_time is None or start_time <= timestamp < end_time:
+            _day(days, timestamp)['adjustments'] += value
+    return days
+
+#########
+# Storage
+
+def load(path):
+    """Load the rollup of the log at path, or None if there is none."""
+    try:
+        with open(rollup_path(path), 'r') as f:
+            rollup = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if rollup.get('version') != ROLLUP_VERSION:
+        return None
+    return rollup
+
+def save(path, rollup):
+    temp_path = rollup_path(path) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(rollup, f)
+    os.rename(temp_path, rollup_path(path))
+
+def _counted_offset(path, rollup):
+    """How far into the log at path the rollup has counted, or 0 if the log was rewritten.
+
+    Returns (offset, md5 object of the log up to it, or None if the log
+    is untouched and wasn't hashed).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (0, None)
+    if stat.st_size < rollup['offset']:
+        return (0, None)
+    if stat.st_size == rollup['size'] and stat.st_mtime == rollup['mtime']:
+        return (rollup['offset'], None)
+    digest = timelog.prefix_digest(path, rollup['offset'])
+    if digest.hexdigest() != rollup['hash']:
+        return (0, None)
+    return (rollup['offset'], digest)
+
+def _segment_hash(path, length):
+    """timelog.prefix_hash() of the uncompressed contents of a segment."""
+    if not timelog.is_compressed(path):
+        return timelog.prefix_hash(path, length)
+    import archive
+    digest = hashlib.md5()
+    for line in archive.read_lines(path, 0, length):
+        digest.update(line)
+    return digest.hexdigest()
+
+def update(path, older=()):
+    """Count the spans of the log at path closed since the last update.
+
+    older lists the log's rolled segments; only those the rollup hasn't
+    read yet are read. The log is counted up to the end of its last closed
+    span. Returns the rollup.
+    """
+    rollup = load(path)
+    if rollup is None:
+        rollup = {'version': ROLLUP_VERSION, 'offset': 0, 'size': 0, 'mtime': 0, 'hash': None, 'through': None, 'adjusted': None, 'segments': [], 'days': {}}
+        offset, digest = 0, None
+    else:
+        offset, digest = _counted_offset(path, rollup)
+    new_segments = [segment for segment in older if os.path.basename(segment) not in rollup['segments']]
+    # If the counted part of the log was rolled or archived, the segment it
+    # went to starts with it, so the saved offset and hash apply there.
+    rolled = None
+    if offset == 0 and rollup['offset']:
+        for segment in new_segments:
+            if _segment_hash(segment, rollup['offset']) == rollup['hash']:
+                rolled = segment
+                break
+    sources = [(segment, rollup['offset'] if segment == rolled else 0, None) for segment in new_segments]
+    end = timelog.closed_length(path) if os.path.exists(path) else 0
+    if end > offset:
+        sources.append((path, offset, end))
+    if not sources:
+        return rollup
+    through = adjusted = None
+    if offset == 0 and rollup['offset'] and rolled is None:
+        # Rewritten in some other way; what was counted can only be told apart by time.
+        through = timelog.from_epoch(rollup['through']) if rollup['through'] is not None else None
+        adjusted = timelog.from_epoch(rollup['adjusted']) if rollup['adjusted'] is not None else None
+    for source, start, stop in sources:
+        days, last, last_adjustment = accumulate(timelog.read_events(source, start, stop), after=through, adjusted=adjusted)
+        merge(rollup['days'], days)
+        if last is not None:
+            rollup['through'] = _later(rollup['through'], timelog.to_epoch(last))
+        if last_adjustment is not None:
+            rollup['adjusted'] = _later(rollup['adjusted'], timelog.to_epoch(last_adjustment))
+    rollup['segments'].extend(os.path.basename(segment) for segment in new_segments)
+    if os.path.exists(path):
+        stat = os.stat(path)
+        if digest is not None:
+            digest = timelog.prefix_digest(path, end, digest, offset)
+        elif offset == 0 or end != offset:
+            digest = timelog.prefix_digest(path, end)
+        rollup.update(offset=end, size=stat.st_size, mtime=stat.st_mtime, hash=digest.hexdigest() if digest is not None else rollup['hash'])
+    else:
+        # Rolled away; the next log is new and read from its start.
+        rollup.update(offset=0, size=0, mtime=0, hash=None)
+    save(path, rollup)
+    return rollup
+
+#########
+# Reports
+
+def period_of(day, by):
+    """The first day of the day, week (from Monday) or month containing day."""
+    if by == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    elif by == 'month':
+        return day.replace(day=1)
+    return day
+
+def periods(days, by):
+    """Group day records into records per day, week or month, keyed by their first date."""
+    grouped = {}
+    for key, record in days.iteritems():
+        period = period_of(datetime.datetime.strptime(key, "%Y-%m-%d").date(), by)
+        add(grouped.setdefault(period, new_day()), record)
+    return grouped
+
+if __name__ == "__main__":
+    # Tests: manual adjustments made while clocked out, reported before and
+    # after a submit rolls the log or an archive rewrites it, count once.
+    import copy
+    import shutil
+    import logging
+    import argparse
+    import tempfile
+    import timecard
+
+    directory = tempfile.mkdtemp(prefix='timecard-rollup-')
+    try:
+        logfile = os.path.join(directory, 'test.log')
+        timecard.logger = logging.getLogger('timecard')
+        loaded_path, config = timecard.load_config([], copy.deepcopy(timecard.default_config))
+        config.update(storage='text', checkpoint=False, rollups=True, segments={'max_size': None})
+        timecard.config = timecard.process_args(argparse.Namespace(logfile=logfile), config)
+        with open(logfile, 'w') as f:
+            f.write("-- Starting log at 09:00:00, Mon Oct 12, 2026 --\n"
+                    "09:00:00, Mon Oct 12, 2026 -- /usr/bin/vim ::: a\n"
+                    "-- Closing log at 10:00:00, Mon Oct 12, 2026 --\n")
+        timecard.write_manual_adjustment(datetime.timedelta(hours=2))
+        def hours():
+            days = timecard.rollup_days(None)[0]
+            return sum(record['seconds'] + record['adjustments'] for record in days.itervalues()) / 3600.0
+        assert hours() == 3, hours()
+        timecard.write_note("[submitted]")
+        timecard.roll_log()
+        assert hours() == 3, hours()
+        timecard.write_manual_adjustment(datetime.timedelta(hours=1))
+        assert hours() == 4, hours()
+        with open(logfile, 'a') as f:
+            f.write("-- Starting log at 09:00:00, Tue Oct 13, 2026 --\n"
+                    "-- Closing log at 10:00:00, Tue Oct 13, 2026 --\n")
+        assert hours() == 5, hours()
+        timecard.archive_log()
+        assert hours() == 5, hours()
+    finally:
+        shutil.rmtree(directory)
+    print "All tests passed."
@@ -1,6 +1,17 @@
 import os
+import time
 import logging
-from gi.repository import Gdk, GdkPixbuf
+import threading
+import collections
+
+# Imported on first use, so loading this module for its constants doesn't
+# pull in GTK.
+GObject = Gdk = GdkPixbuf = None
+
+def _import_gi():
+    global GObject, Gdk, GdkPixbuf
+    if Gdk is None:
+        from gi.repository import GObject, Gdk, GdkPixbuf
 
 ARBITRARY_AREA = 0 # Specified area
 ACTIVE_WINDOW = 1 # Focused/top window only
@@ -10,8 +21,13 @@ ENTIRE_DESKTOP = 4 # Everything
 
 logger = logging.getLogger(__name__)
 
+# Written next to screenshots skipped as duplicates, mapping each to the
+# earlier frame that was kept.
+DUPLICATES_INDEX = 'duplicates.log'
+
 def get_active_window(root=None):
     """Returns the active (focused, top) window, or None."""
+    _import_gi()
     root = root or Gdk.Screen.get_default()
     active = root.get_active_window()
     if not active:
@@ -20,6 +36,7 @@ def get_active_window(root=None):
 
 def get_active_monitor(root=None):
     """Returns the index of the active monitor, or -1 if undetermined."""
+    _import_gi()
     root = root or Gdk.Screen.get_default()
     num_monitors = root.get_n_monitors()
     if (num_monitors == 1):
@@ -30,19 +47,10 @@ def get_active_monitor(root=None):
     else:
         return -1
 
-def take_screenshot(filepath, target=ACTIVE_MONITOR, fmt="png", scale=1.0, area=(0,0,0,0), fmt_options=None):
-    """Take a screenshot of the desired target area."""
+def capture(target=ACTIVE_MONITOR, area=(0,0,0,0)):
+    """Grab the pixels of the desired target area. Must run on the main thread."""
     logger.debug("Taking screenshot (target=%d)." % target)
-    # Avoid persistent mutable default parameters
-    if fmt_options == None:
-        fmt_options = {}
-    
-    # Allow callable so filepath can be calculated on the fly from a timer.
-    try:
-        filepath = filepath()
-    except TypeError:
-        pass
-    
+    _import_gi()
     root = Gdk.Screen.get_default()
     root_win = root.get_root_window()
     active = get_active_window(root)
@@ -69,9 +77,30 @@ def take_screenshot(filepath, target=ACTIVE_MONITOR, fmt="png", scale=1.0, area=
     
     logger.debug("Area = (x=%d, y=%d, w=%d, h=%d)" % (x, y, w, h))
     #pb = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, w, h)
-    pb = Gdk.pixbuf_get_from_window(root_win, x, y, w, h)
-    pb = pb.scale_simple(int(w*scale), int(h*scale), GdkPixbuf.InterpType.BILINEAR)
-    
+    return Gdk.pixbuf_get_from_window(root_win, x, y, w, h)
+
+def frame_signature(pb, size=16):
+    """Downsample a pixbuf to a size x size grayscale thumbnail for comparison."""
+    _import_gi()
+    small = pb.scale_simple(size, size, GdkPixbuf.InterpType.TILES)
+    pixels = bytearray(small.get_pixels())
+    rowstride = small.get_rowstride()
+    channels = small.get_n_channels()
+    thumbnail = []
+    for y in xrange(size):
+        for x in xrange(size):
+            i = y*rowstride + x*channels
+            thumbnail.append((pixels[i] + pixels[i+1] + pixels[i+2]) // 3)
+    return (pb.get_width(), pb.get_height(), thumbnail)
+
+def frame_difference(a, b):
+    """Return the mean difference between two frame signatures, from 0.0 to 1.0."""
+    if a[:2] != b[:2]:
+        return 1.0
+    return sum(abs(p - q) for p, q in zip(a[2], b[2])) / (255. * len(a[2]))
+
+def screenshot_path(filepath, fmt="png"):
+    """Return the filename and pixbuf format a screenshot will be saved with."""
     if fmt == "jpg":
         # "jpeg" required for pb.save format string
         if not (filepath.endswith('.jpg') or filepath.endswith('.jpeg')):
@@ -80,19 +109,127 @@ def take_screenshot(filepath, target=ACTIVE_MONITOR, fmt="png", scale=1.0, area=
     else:
         if not filepath.endswith('.'+fmt):
             filepath += '.'+fmt
+    return (filepath, fmt)
+
+def save_pixbuf(pb, filepath, fmt="png", scale=1.0, fmt_options=None):
+    """Scale, encode and write a captured pixbuf. Safe to run off the main thread."""
+    # Avoid persistent mutable default parameters
+    if fmt_options == None:
+        fmt_options = {}
     
+    filepath, fmt = screenshot_path(filepath, fmt)
     if pb == None:
         logger.error("Failed to save screenshot to %s." % filepath)
         return False
-    else:
-        logger.debug("Saving screenshot to %s." % filepath)
+    if scale != 1.0:
+        _import_gi()
+        pb = pb.scale_simple(int(pb.get_width()*scale), int(pb.get_height()*scale), GdkPixbuf.InterpType.BILINEAR)
+    logger.debug("Saving screenshot to %s." % filepath)
+    try:
+        pb.savev(filepath, fmt, fmt_options.keys(), fmt_options.values())
+    except Exception as e:
+        logger.error("Failed to save screenshot to %s: %s." % (filepath, e))
+        return False
+    return True
+
+def take_screenshot(filepath, target=ACTIVE_MONITOR, fmt="png", scale=1.0, area=(0,0,0,0), fmt_options=None):
+    """Take a screenshot of the desired target area."""
+    # Allow callable so filepath can be calculated on the fly from a timer.
+    try:
+        filepath = filepath()
+    except TypeError:
+        pass
+    return save_pixbuf(capture(target, area), filepath, fmt, scale, fmt_options)
+
+class ScreenshotPipeline(object):
+    """Capture on the main thread, then scale, encode and write on workers.
+    
+    At most max_pending captured frames wait for a worker; when the queue is
+    full the oldest waiting frame is dropped so capture never blocks.
+    
+    If dedupe_threshold is set, a frame differing from the last one kept for
+    the same target by less than that fraction is not written; it is only
+    recorded in DUPLICATES_INDEX as a reference to the earlier file.
+    """
+    def __init__(self, workers=1, max_pending=4, dedupe_threshold=None):
+        _import_gi()
+        GObject.threads_init()
+        self.max_pending = max_pending
+        self.dedupe_threshold = dedupe_threshold
+        # target -> (signature, path) of the last frame written
+        self.previous = {}
+        self.pending = collections.deque()
+        self.lock = threading.Condition()
+        self.closing = False
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work, name="screenshot-%d" % (i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, pb, filepath, fmt="png", scale=1.0, fmt_options=None, target=None):
+        import stats
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                dropped = self.pending.popleft()
+                stats.count('screenshots.dropped')
+                logger.warning("Screenshot queue full, dropping %s." % (dropped[1],))
+            self.pending.append((pb, filepath, fmt, scale, fmt_options, target, time.time()))
+            logger.debug("Screenshot queue depth: %d" % (len(self.pending)))
+            self.lock.notify()
+
+    def take_screenshot(self, filepath, target=ACTIVE_MONITOR, fmt="png", scale=1.0, area=(0,0,0,0), fmt_options=None):
+        """Capture now and queue the frame for saving. Usable as a GLib timeout."""
         try:
-            pb.savev(filepath, fmt, fmt_options.keys(), fmt_options.values())
-        except Exception as e:
-            logger.error("Failed to save screenshot to %s: %s." % (filepath, e))
-            return False
+            filepath = filepath()
+        except TypeError:
+            pass
+        self.submit(capture(target, area), filepath, fmt, scale, fmt_options, target)
         return True
 
+    def _work(self):
+        import stats
+        while True:
+            with self.lock:
+                while not self.pending and not self.closing:
+                    self.lock.wait()
+                if not self.pending:
+                    return
+                pb, filepath, fmt, scale, fmt_options, target, queued = self.pending.popleft()
+            start = time.time()
+            if self.dedupe_threshold is not None and pb is not None and self._is_duplicate(pb, filepath, fmt, target):
+                continue
+            save_pixbuf(pb, filepath, fmt, scale, fmt_options)
+            stats.observe('screenshot.encode', time.time() - start)
+            stats.observe('screenshot.queued', time.time() - queued)
+            logger.debug("Encoded %s in %.3f s (%.3f s after capture)." % (filepath, time.time() - start, time.time() - queued))
+
+    def _is_duplicate(self, pb, filepath, fmt, target):
+        """Check pb against the last frame kept for target, recording it if it's a repeat."""
+        import stats
+        signature = frame_signature(pb)
+        path = screenshot_path(filepath, fmt)[0]
+        with self.lock:
+            previous = self.previous.get(target)
+            if previous is None or frame_difference(signature, previous[0]) >= self.dedupe_threshold:
+                self.previous[target] = (signature, path)
+                return False
+        stats.count('screenshots.duplicates')
+        logger.debug("Skipping duplicate screenshot %s (same as %s)." % (path, previous[1]))
+        index = open(os.path.join(os.path.dirname(path), DUPLICATES_INDEX), 'a')
+        print >>index, "%s -> %s" % (os.path.basename(path), os.path.basename(previous[1]))
+        index.close()
+        return True
+
+    def close(self, timeout=10):
+        """Finish the frames already queued, then stop the workers."""
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
 
 if __name__ == "__main__":
     # Tests
@@ -0,0 +1,205 @@
+"""segments.py
+
+Pay-period log segments.
+
+Closed parts of a log are rolled into segment files next to it, and a
+<logfile>.manifest records each segment's time range, spans, adjustments,
+totals and last [submitted] marker. Summaries can then be built from the
+manifest alone, and time range queries only need to open the segments
+that overlap them.
+"""
+
+import os
+import json
+import shutil
+import datetime
+import logging
+import timelog
+import archive
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+def manifest_path(logfile):
+    return logfile + '.manifest'
+
+def load_manifest(logfile):
+    try:
+        with open(manifest_path(logfile), 'r') as f:
+            manifest = json.load(f)
+    except IOError:
+        return {'version': MANIFEST_VERSION, 'segments': []}
+    return manifest
+
+def save_manifest(logfile, manifest):
+    temp_path = manifest_path(logfile) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(temp_path, manifest_path(logfile))
+
+def segment_file(logfile, entry):
+    """Absolute path of a segment listed in the manifest."""
+    return os.path.join(os.path.dirname(os.path.abspath(logfile)), entry['path'])
+
+def _epoch(dt):
+    return timelog.to_epoch(dt) if dt is not None else None
+
+def _datetime(seconds):
+    return timelog.from_epoch(seconds) if seconds is not None else None
+
+def _segment_name(logfile, start, extension=''):
+    """Pick an unused segment file name stamped with its start time."""
+    base, ext = os.path.splitext(logfile)
+    stamp = (start or datetime.datetime.now()).strftime("%Y%m%d-%H%M%S")
+    name = "%s.%s%s" % (base, stamp, ext)
+    n = 1
+    while any(os.path.exists(name + e) for e in ('',) + timelog.COMPRESSED_EXTENSIONS):
+        name = "%s.%s-%d%s" % (base, stamp, n, ext)
+        n += 1
+    return name + extension
+
+def _time_range(spans, adjustments, last_paid):
+    timestamps = [s[0].timestamp for s in spans] + [s[-1].timestamp for s in spans] + [a[0] for a in adjustments]
+    if last_paid is not None:
+        timestamps.append(last_paid)
+    if not timestamps:
+        return (None, None)
+    return (min(timestamps), max(timestamps))
+
+def _entry(name, spans, adjustments, last_paid):
+    """The manifest entry of a segment."""
+    start, end = _time_range(spans, adjustments, last_paid)
+    return {
+        'path': os.path.basename(name),
+        'start': _epoch(start),
+        'end': _epoch(end),
+        'hours': sum((s[-1].timestamp - s[0].timestamp).total_seconds() for s in spans)/3600.,
+        'adjustments': [[_epoch(t), seconds] for t, seconds in adjustments],
+        'spans': [[_epoch(s[0].timestamp), _epoch(s[-1].timestamp), int(s[-1].kind == timelog.CLOSE)] for s in spans],
+        'last_paid': _epoch(last_paid),
+        'compressed': archive.is_archive(name)
+    }
+
+def _record(logfile, entry):
+    """Add a segment's entry to the manifest and return it."""
+    manifest = load_manifest(logfile)
+    manifest['segments'].append(entry)
+    save_manifest(logfile, manifest)
+    logger.debug("Added segment %s to %s.", entry['path'], manifest_path(logfile))
+    return entry
+
+def roll(logfile, spans, adjustments, last_paid, compress=False):
+    """Move the live log into a new segment and record it in the manifest.
+
+    spans, adjustments and last_paid are the parsed contents of the live log,
+    as returned by get_spans(). compress is False, True for gzip, or an
+    archive codec name. Returns the manifest entry, or None if there was
+    nothing to roll.
+    """
+    if not os.path.exists(logfile) or os.path.getsize(logfile) == 0:
+        return None
+    binary = timelog.is_binary(logfile)
+    name = _segment_name(logfile, _time_range(spans, adjustments, last_paid)[0])
+    os.rename(logfile, name)
+    if binary:
+        import binlog
+        for table in ('commands', 'windows'):
+            if os.path.exists(binlog.table_path(logfile, table)):
+                os.rename(binlog.table_path(logfile, table), binlog.table_path(name, table))
+    try:
+        os.remove(timelog.checkpoint_path(logfile))
+    except OSError:
+        pass
+    if compress and not binary:
+        name = compress_file(name, 'gz' if compress is True else compress)
+    logger.debug("Rolled %s into %s.", logfile, name)
+    return _record(logfile, _entry(name, spans, adjustments, last_paid))
+
+def archive_closed(logfile, end, spans, adjustments, last_paid, codec='gz'):
+    """Compress the first end bytes of a text log into a segment, keeping the rest live.
+
+    spans, adjustments and last_paid are the parsed contents of that part
+    of the log. Nothing may be appended to the log meanwhile: call this
+    with the timecard's lock held. Returns the manifest entry, or None if
+    there was nothing to archive.
+    """
+    entry = compress_closed(logfile, end, spans, adjustments, last_paid, codec)
+    if entry is None:
+        return None
+    return drop_closed(logfile, end, entry)
+
+def compress_closed(logfile, end, spans, adjustments, last_paid, codec='gz'):
+    """Compress the first end bytes of a text log into a new segment file.
+
+    Lines before the last closed span are never rewritten, so this needs
+    no lock. Returns the segment's manifest entry, to be passed on to
+    drop_closed(), or None if there was nothing to archive.
+    """
+    if not end:
+        return None
+    name = _segment_name(logfile, _time_range(spans, adjustments, last_paid)[0], archive.codecs[codec])
+    archive.compress(logfile, name, codec, 0, end)
+    return _entry(name, spans, adjustments, last_paid)
+
+def drop_closed(logfile, end, entry):
+    """Cut the first end bytes, now compressed into entry's segment, from a text log.
+
+    The live log is replaced by a copy of the remaining tail, so nothing
+    may be appended to it meanwhile: call this from the running timecard,
+    or with its lock held. Records the segment and returns its entry.
+    """
+    temp_path = logfile + '.tmp'
+    with open(logfile, 'r') as source:
+        source.seek(end)
+        with open(temp_path, 'w') as tail:
+            shutil.copyfileobj(source, tail)
+        os.rename(temp_path, logfile)
+    try:
+        os.remove(timelog.checkpoint_path(logfile))
+    except OSError:
+        pass
+    logger.debug("Archived %d bytes of %s into %s.", end, logfile, entry['path'])
+    return _record(logfile, entry)
+
+def compress_file(path, codec='gz'):
+    """Compress a closed segment into a framed archive, replacing it. Returns the new path."""
+    destination = path + archive.codecs[codec]
+    archive.compress(path, destination, codec)
+    os.remove(path)
+    return destination
+
+def needs_roll(logfile, max_size=None, monthly=False, now=None):
+    """Check the live log against the size and calendar month thresholds."""
+    if not os.path.exists(logfile) or os.path.getsize(logfile) == 0:
+        return False
+    if max_size and os.path.getsize(logfile) >= max_size:
+        return True
+    if monthly:
+        now = now or datetime.datetime.now()
+        for event in timelog.read_events(logfile):
+            return (event.timestamp.year, event.timestamp.month) != (now.year, now.month)
+    return False
+
+def overlapping(manifest, start_time=None, end_time=None):
+    """Manifest entries for segments overlapping [start_time, end_time]."""
+    if start_time is None:
+        return list(manifest['segments'])
+    start, end = _epoch(start_time), _epoch(end_time)
+    return [e for e in manifest['segments'] if e['start'] is None or (e['end'] >= start and e['start'] <= end)]
+
+def last_paid(manifest):
+    """The latest [submitted] marker recorded in any segment, or None."""
+    paid = [e['last_paid'] for e in manifest['segments'] if e['last_paid'] is not None]
+    return _datetime(max(paid)) if paid else None
+
+def spans(entries):
+    """Rebuild get_spans()-style spans and adjustments from manifest entries."""
+    result = []
+    adjustments = []
+    for entry in entries:
+        for start, end, closed in entry['spans']:
+            result.append([timelog.Event(_datetime(start), timelog.START, None, None, None),
+                           timelog.Event(_datetime(end), timelog.CLOSE if closed else timelog.WINDOW, None, None, None)])
+        adjustments.extend((_datetime(t), seconds) for t, seconds in entry['adjustments'])
+    return (result, adjustments)
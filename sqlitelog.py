@@ -0,0 +1,160 @@
+"""sqlitelog.py
+
+SQLite storage backend for timecard logs.
+"""
+
+import sqlite3
+import datetime
+import logging
+import timelog
+
+logger = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS spans (
+    id INTEGER PRIMARY KEY,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    closed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    span_id INTEGER REFERENCES spans (id),
+    timestamp INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    command TEXT,
+    window TEXT,
+    value,
+    duration INTEGER
+);
+CREATE INDEX IF NOT EXISTS spans_start ON spans (start);
+CREATE INDEX IF NOT EXISTS spans_end ON spans (end);
+CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp);
+CREATE INDEX IF NOT EXISTS events_span ON events (span_id);
+CREATE INDEX IF NOT EXISTS events_kind ON events (kind, timestamp);
+CREATE INDEX IF NOT EXISTS events_command ON events (command);
+CREATE INDEX IF NOT EXISTS events_window ON events (window);
+"""
+
+class SqliteLog(object):
+    """A timecard log stored in an SQLite database.
+
+    Window events are stored with the time until the next event in the same
+    span, so reports are plain indexed aggregate queries.
+    """
+    def __init__(self, path, timeout=30):
+        self.path = path
+        # A daemon may hold a write transaction open between flushes.
+        self.db = sqlite3.connect(path, timeout=timeout)
+        self.db.text_factory = str
+        self.db.executescript(schema)
+        self._load_open_span()
+
+    def _load_open_span(self):
+        """Find the span (and its last window event) still open for appends."""
+        self.span_id = None
+        self.last_window = None
+        row = self.db.execute("SELECT id FROM spans WHERE closed = 0 ORDER BY id DESC LIMIT 1").fetchone()
+        if row:
+            self.span_id = row[0]
+            self.last_window = self.db.execute("SELECT id, timestamp FROM events WHERE span_id = ? AND kind = ? ORDER BY id DESC LIMIT 1", (self.span_id, timelog.WINDOW)).fetchone()
+
+    def append(self, line):
+        """Parse a text log line and store it. Returns False if it isn't an event."""
+        event = timelog.parse_line(line.strip())
+        if event is None:
+            return False
+        self.append_event(event)
+        return True
+
+    def append_event(self, event):
+        """Store an Event, keeping span ends and window durations up to date."""
+        timestamp = timelog.to_epoch(event.timestamp)
+        if event.kind == timelog.START:
+            if self.span_id is not None:
+                # The previous span was never closed; it ends at its last entry.
+                self.db.execute("UPDATE spans SET closed = 1 WHERE id = ?", (self.span_id,))
+            self.span_id = self.db.execute("INSERT INTO spans (start, end) VALUES (?, ?)", (timestamp, timestamp)).lastrowid
+            self.last_window = None
+        elif self.span_id is not None:
+            self.db.execute("UPDATE spans SET end = ?, closed = ? WHERE id = ?", (timestamp, int(event.kind == timelog.CLOSE), self.span_id))
+            if self.last_window and event.kind in (timelog.WINDOW, timelog.CLOSE):
+                self.db.execute("UPDATE events SET duration = ? WHERE id = ?", (timestamp - self.last_window[1], self.last_window[0]))
+        event_id = self.db.execute("INSERT INTO events (span_id, timestamp, kind, command, window, value) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (self.span_id, timestamp, event.kind, event.command, event.window, event.value)).lastrowid
+        if event.kind == timelog.WINDOW and self.span_id is not None:
+            self.last_window = (event_id, timestamp)
+        elif event.kind == timelog.CLOSE:
+            self.span_id = None
+            self.last_window = None
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def import_text(self, path):
+        """Bulk-load a text log into the database in a single transaction.
+
+        Raises ValueError if the database already holds events, so that a
+        log is never imported twice.
+        """
+        count = 0
+        # Take the write lock before looking, so nothing is appended in between.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            if self.db.execute("SELECT 1 FROM events LIMIT 1").fetchone():
+                raise ValueError, "%s already holds a log" % (self.path,)
+            for event in timelog.read_events(path):
+                self.append_event(event)
+                count += 1
+        except:
+            self.db.rollback()
+            self._load_open_span()
+            raise
+        self.db.commit()
+        return count
+
+    def last_paid(self):
+        row = self.db.execute("SELECT MAX(timestamp) FROM events WHERE kind = ?", (timelog.SUBMITTED,)).fetchone()
+        return timelog.from_epoch(row[0]) if row[0] is not None else None
+
+    def adjustments(self):
+        return [(timelog.from_epoch(t), int(v)) for t, v in self.db.execute("SELECT timestamp, value FROM events WHERE kind = ? ORDER BY timestamp", (timelog.MANUAL,))]
+
+    def spans(self, start_time=None, end_time=None):
+        """Return spans overlapping [start_time, end_time] in get_spans() form."""
+        query = "SELECT start, end, closed FROM spans"
+        params = ()
+        if start_time is not None:
+            query += " WHERE end >= ? AND start <= ?"
+            params = (timelog.to_epoch(start_time), timelog.to_epoch(end_time))
+        spans = []
+        for start, end, closed in self.db.execute(query + " ORDER BY start", params):
+            spans.append([timelog.Event(timelog.from_epoch(start), timelog.START, None, None, None),
+                          timelog.Event(timelog.from_epoch(end), timelog.CLOSE if closed else timelog.WINDOW, None, None, None)])
+        return spans
+
+    def histogram(self, column, start_time=None, end_time=None):
+        """Total time per distinct command or window name, clipped to the range."""
+        if column not in ('command', 'window'):
+            raise ValueError, "unknown column %s" % (column,)
+        return {name: datetime.timedelta(seconds=seconds) for name, seconds in self._totals(column, start_time, end_time)}
+
+    def pair_histogram(self, start_time=None, end_time=None):
+        """Total time per distinct (command, window) pair, clipped to the range."""
+        return {(command, window): datetime.timedelta(seconds=seconds)
+                for command, window, seconds in self._totals('command, window', start_time, end_time)}
+
+    def _totals(self, column, start_time, end_time):
+        if start_time is None:
+            rows = self.db.execute("SELECT %s, SUM(duration) FROM events WHERE kind = ? AND duration IS NOT NULL GROUP BY %s" % (column, column), (timelog.WINDOW,))
+        else:
+            start, end = timelog.to_epoch(start_time), timelog.to_epoch(end_time)
+            rows = self.db.execute("""SELECT %s, SUM(MIN(timestamp + duration, :end) - MAX(timestamp, :start)) FROM events
+                WHERE span_id IN (SELECT id FROM spans WHERE end > :start AND start < :end)
+                AND kind = :kind AND duration IS NOT NULL AND timestamp < :end AND timestamp + duration > :start
+                GROUP BY %s""" % (column, column), {'start': start, 'end': end, 'kind': timelog.WINDOW})
+        return rows
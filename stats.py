@@ -0,0 +1,128 @@
+"""stats.py
+
+Runtime instrumentation for the monitoring daemon.
+
+Callbacks record their latency into histograms, other code bumps named
+counters, and gauges are read when a snapshot is taken. The daemon hands
+out snapshots over its control socket for the stats command.
+"""
+
+import os
+import time
+import logging
+import functools
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets, in milliseconds; one more bucket
+# catches anything slower.
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Histogram(object):
+    """Counts of observed latencies per bucket, plus their total and maximum."""
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        i = 0
+        while i < len(self.bounds) and ms > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def as_dict(self):
+        return {'bounds': list(self.bounds), 'counts': list(self.counts), 'count': self.count, 'total': self.total, 'max': self.max}
+
+def percentile(histogram, q):
+    """Estimate a percentile of a Histogram.as_dict() as its bucket's upper bound."""
+    if not histogram['count']:
+        return 0.0
+    seen = 0
+    for bound, count in zip(histogram['bounds'], histogram['counts']):
+        seen += count
+        if seen >= q * histogram['count']:
+            return min(bound, histogram['max'])
+    return histogram['max']
+
+started = time.time()
+counters = {}
+histograms = {}
+# name -> callable returning the current value
+gauges = {}
+_lock = threading.Lock()
+
+def count(name, n=1):
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+def observe(name, seconds):
+    with _lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds * 1000)
+
+def timed(name):
+    """Decorator recording the latency of every call into histogram name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.time() - start)
+        return wrapper
+    return decorator
+
+def process_stats():
+    """Resident memory in bytes and open file descriptors of this process."""
+    try:
+        rss = int(open('/proc/self/statm', 'r').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError, IndexError):
+        rss = None
+    try:
+        fds = len(os.listdir('/proc/self/fd'))
+    except OSError:
+        fds = None
+    return {'rss': rss, 'fds': fds}
+
+def snapshot():
+    """All current numbers, as a JSON-serializable dict."""
+    result = dict(process_stats(), pid=os.getpid(), uptime=time.time() - started)
+    with _lock:
+        result['counters'] = dict(counters)
+        result['histograms'] = dict((name, h.as_dict()) for name, h in histograms.items())
+    result['gauges'] = {}
+    for name, gauge in gauges.items():
+        try:
+            result['gauges'][name] = gauge()
+        except Exception as e:
+            logger.debug("Gauge %s failed: %s" % (name, e))
+    return result
+
+def format_snapshot(snapshot):
+    """Render a snapshot as a plain-text report."""
+    lines = []
+    uptime = int(snapshot['uptime'])
+    lines.append("pid %d, up %d:%02d:%02d" % (snapshot['pid'], uptime // 3600, uptime // 60 % 60, uptime % 60))
+    if snapshot['rss'] is not None:
+        lines.append("RSS %.1f MB, %s open file descriptors" % (snapshot['rss'] / 1048576., snapshot['fds']))
+    if snapshot['counters'] or snapshot['gauges']:
+        lines.append("")
+        for name, value in sorted(snapshot['counters'].items() + snapshot['gauges'].items()):
+            lines.append("%-32s %10s" % (name, value))
+    if snapshot['histograms']:
+        lines.append("")
+        lines.append("%-32s %8s %8s %8s %8s %8s %8s" % ("Latency (ms)", "calls", "mean", "p50", "p90", "p99", "max"))
+        for name, h in sorted(snapshot['histograms'].items()):
+            lines.append("%-32s %8d %8.2f %8.2f %8.2f %8.2f %8.2f" % (name, h['count'], h['total'] / max(h['count'], 1),
+                         percentile(h, 0.5), percentile(h, 0.9), percentile(h, 0.99), h['max']))
+    return '\n'.join(lines)
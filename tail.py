@@ -0,0 +1,116 @@
+"""tail.py
+
+Waiting for a log file to change, through inotify or by polling its stat.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII') # wd, mask, cookie, length of the name that follows
+
+def _inotify_watch(directory):
+    """Return an inotify descriptor watching directory, or raise OSError."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    try:
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except AttributeError:
+        raise OSError, (errno.ENOSYS, "inotify is not available")
+    fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        error = ctypes.get_errno()
+        raise OSError, (error, os.strerror(error))
+    if inotify_add_watch(fd, directory, WATCH_MASK) < 0:
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError, (error, os.strerror(error))
+    return fd
+
+class FileWatcher(object):
+    """Waits for changes to one file, which may be replaced or not exist yet.
+
+    Watches the file's directory through inotify, so a log that is rolled
+    or rewritten is still followed. Without inotify, it compares the file's
+    stat every poll_interval seconds instead.
+    """
+    def __init__(self, path, poll_interval=1.0):
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path)
+        self.poll_interval = poll_interval
+        self.state = self._stat()
+        try:
+            self.fd = _inotify_watch(os.path.dirname(self.path))
+        except OSError as e:
+            logger.debug("Polling %s, no inotify: %s" % (self.path, e))
+            self.fd = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def wait(self, timeout=None):
+        """Block until the file changes or timeout seconds pass; return whether it changed."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.fd is not None:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            readable, writable, exceptional = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            # Other files in the directory changing doesn't count.
+            if self._read_events():
+                return True
+        while True:
+            state = self._stat()
+            if state != self.state:
+                self.state = state
+                return True
+            if deadline is None:
+                time.sleep(self.poll_interval)
+            elif time.time() >= deadline:
+                return False
+            else:
+                time.sleep(min(self.poll_interval, max(deadline - time.time(), 0)))
+
+    def _read_events(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset+EVENT.size:offset+EVENT.size+length].rstrip('\0')
+                offset += EVENT.size + length
+                if name == self.name:
+                    changed = True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -14,12 +14,23 @@ import time
 import argparse
 import datetime
 import re
+import json
 import ctypes
-import yaml
-from dateutil import parser as dateparser
-from gi.repository import Gtk, GLib, Wnck, Notify
-from sh import ps
+import socket
+import errno
+import fcntl
+import hashlib
 import screenshot
+import timelog
+# The rest of the package is imported by the commands that use it.
+
+# GTK, Wnck and libnotify are only needed by the monitoring daemon, and
+# importing them is most of the start-up time of every other command.
+Gtk = GLib = Wnck = Notify = None
+
+def import_gui():
+    global Gtk, GLib, Wnck, Notify
+    from gi.repository import Gtk, GLib, Wnck, Notify
 
 class XScreenSaverInfo( ctypes.Structure):
     """ typedef struct { ... } XScreenSaverInfo; """
@@ -46,20 +57,97 @@ idle_actions = {
     'stop': lambda t: stop_monitoring(signal.SIGTERM, None)
 }
 
+# Seconds between summarize --follow refreshes while the log is quiet,
+# to keep the open span's total current.
+follow_refresh = 60
+
 config_paths = [
     os.environ['HOME']+'/.config/timecard/timecard.conf',
     '/etc/timecard/timecard.conf'
 ]
 
+# Parsed config files are cached here as JSON, which loads much faster than YAML.
+config_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.environ['HOME']+'/.cache'), 'timecard')
+
 default_config = {
     'logfile': 'timecard.log',
+    'checkpoint': True,
+    'rollups': True, # keep per-day totals of text logs for summarize --by
+    'storage': 'text', # or 'sqlite' or 'binary'
+    'database': None, # defaults to the logfile with a .db extension
+    'writer': {
+        'buffer': 4096, # bytes
+        'delay': 10, # seconds
+        'fsync': 'close' # never, flush or close
+    },
+    'segments': False, # or {'max_size': bytes, 'monthly': bool, 'compress': bool or 'gz', 'xz', 'zst'}
+    'titles': {
+        'settle': 1.0, # seconds a title must stay before it is logged
+        'rate': 30 # most titles logged per process per minute
+    },
     'screenshots': False,
+    'projects': False, # or a list of {'project', 'command', 'window', 'glob'} rules, see classify.py
+    'reminder': False, # or {'keywords': [...], 'repeat': seconds}, for reminder.py
     'idle': {
         'time': 480, #seconds
-        'action': 'warning'
+        'action': 'warning',
+        'mode': 'poll' # or 'transition'
     }
 }
 
+def _yaml_strings(value):
+    """Turn the unicode strings json gives back into str where yaml would have."""
+    if isinstance(value, dict):
+        return dict((_yaml_strings(k), _yaml_strings(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return [_yaml_strings(v) for v in value]
+    elif isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    return value
+
+def read_config_file(path):
+    """Parse a YAML config file, using the cached copy if the file hasn't changed."""
+    info = os.stat(path)
+    cache_path = os.path.join(config_cache_dir, hashlib.md5(os.path.abspath(path)).hexdigest()+'.json')
+    try:
+        cached = json.load(open(cache_path, 'r'))
+        if cached['mtime'] == info.st_mtime and cached['size'] == info.st_size:
+            return _yaml_strings(cached['config'])
+    except (IOError, ValueError, KeyError):
+        pass
+    import yaml
+    try:
+        parsed = yaml.load(open(path, 'r'))
+    except yaml.YAMLError:
+        raise ValueError, "Invalid config syntax in %s" % (path,)
+    try:
+        if not os.path.isdir(config_cache_dir):
+            os.makedirs(config_cache_dir)
+        temp_path = cache_path + '.tmp'
+        json.dump({'mtime': info.st_mtime, 'size': info.st_size, 'config': parsed}, open(temp_path, 'w'))
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        # Not JSON-serializable, or nowhere to write; just parse it every time.
+        logger.debug("Could not cache %s: %s", path, e)
+    return parsed
+
+def merge_config(default, overrides):
+    """Merge a parsed config over the defaults, section by section.
+
+    A section given as a mapping only overrides the keys it sets; any other
+    value, such as False, replaces the default section entirely.
+    """
+    config = {}
+    for key in set(default) | set(overrides):
+        value = overrides.get(key, default.get(key))
+        if isinstance(default.get(key), dict) and isinstance(value, dict):
+            value = merge_config(default[key], value)
+        config[key] = value
+    return config
+
 def load_config(paths, default=default_config):
     """Load a YAML configuration file into a dict.
     
@@ -71,15 +159,15 @@ def load_config(paths, default=default_config):
     loaded_path = None
     for path in paths:
         try:
-            config = dict(default.items() + yaml.load(open(path, 'r')).items())
+            config = merge_config(default, read_config_file(path) or {})
             loaded_path = path
-        except yaml.YAMLError:
-            print "Invalid config syntax in %s" % (path,)
+        except ValueError as e:
+            print e
             continue
-        except IOError:
+        except (IOError, OSError):
             continue
     if not config:
-        config = dict(default)
+        config = merge_config(default, {})
     
     # Convert string constants into int constants
     if config['screenshots'] and config['screenshots']['type']:
@@ -95,7 +183,30 @@ def load_config(paths, default=default_config):
     
     return (loaded_path, config)
 
+def test_config():
+    """Check that a partial config section keeps the defaults it doesn't set."""
+    global config_cache_dir
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp(prefix='timecard-config-')
+    cache_dir = config_cache_dir
+    try:
+        config_cache_dir = os.path.join(directory, 'cache')
+        config_path = os.path.join(directory, 'timecard.conf')
+        with open(config_path, 'w') as f:
+            print >>f, "titles: {settle: 2}"
+            print >>f, "idle: false"
+        loaded_path, config = load_config([config_path])
+        assert loaded_path == config_path
+        assert config['titles'] == {'settle': 2, 'rate': 30}, config['titles']
+        assert config['idle'] is False, config['idle']
+        assert config['writer'] == default_config['writer'], config['writer']
+    finally:
+        config_cache_dir = cache_dir
+        shutil.rmtree(directory)
+
 def save_config(path, config):
+    import yaml
     open(path, 'w').write(yaml.dump(config, default_flow_style=False))
 
 def process_args(args, config):
@@ -104,6 +215,9 @@ def process_args(args, config):
     config['logfile'] = args.logfile
     config['cardname'] = os.path.splitext(os.path.split(config['logfile'])[1])[0]
     config['lockfile'] = os.path.join('/tmp', config['cardname']+'.lock')
+    config['socket'] = os.path.join('/tmp', config['cardname']+'.sock')
+    if not config['database']:
+        config['database'] = os.path.splitext(config['logfile'])[0]+'.db'
     
     if 'screenshots' in args:
         if not args.screenshots:
@@ -123,6 +237,8 @@ def process_args(args, config):
                 config['screenshots']['interval'] = args.screenshot_interval
             if args.notify != None:
                 config['screenshots']['notify'] = args.notify
+        if config['screenshots'] and args.dedupe != None:
+            config['screenshots']['dedupe'] = args.dedupe
     
     if 'idletime' in args and args.idletime != None:
         if config['idle']:
@@ -132,6 +248,9 @@ def process_args(args, config):
     if 'idle_action' in args and args.idle_action in idle_actions:
         if config['idle']:
             config['idle']['action'] = idle_actions[args.idle_action]
+    if 'idle_mode' in args and args.idle_mode != None:
+        if config['idle']:
+            config['idle']['mode'] = args.idle_mode
     
     logger.debug("Arguments:")
     for arg, val in vars(args).items():
@@ -140,7 +259,9 @@ def process_args(args, config):
     for key, val in config.items():
         logger.debug("  %s = %s", key, val)
     
-    logger.debug(yaml.dump(config, default_flow_style=False))
+    if logger.isEnabledFor(logging.DEBUG):
+        import yaml
+        logger.debug(yaml.dump(config, default_flow_style=False))
     
     return config
 
@@ -167,69 +288,211 @@ def get_active_window():
     window_title = ' '.join(subprocess.check_output(['xprop', '-id', str(window_id), '-f', '_NET_WM_NAME', '0s', r' $0\n', '_NET_WM_NAME']).split()[1:]).strip('"')
     return window_title
 
+# pid -> (process start time, command line)
+command_cache = {}
+command_cache_stats = {'hits': 0, 'misses': 0}
+
+def get_process_start(pid):
+    """Return the start time of pid in clock ticks since boot, from /proc."""
+    stat = open('/proc/%d/stat' % (pid), 'r').read()
+    # The command name may contain spaces; starttime is the 20th field after it.
+    return int(stat[stat.rindex(')')+2:].split()[19])
+
+# Without /proc, ps is asked instead, at the cost of a fork per lookup.
+have_proc = os.path.isdir('/proc/self')
+
+def get_process_cmd(pid):
+    """Return the command line of pid, cached until the pid is reused.
+
+    Returns "" if the process has already exited.
+    """
+    if not pid:
+        return ""
+    if not have_proc:
+        from sh import ps, ErrorReturnCode
+        try:
+            return ps('-p', pid, '-o', 'cmd', 'h').strip()
+        except ErrorReturnCode:
+            return ""
+    try:
+        start = get_process_start(pid)
+    except (IOError, ValueError, IndexError):
+        return ""
+    cached = command_cache.get(pid)
+    if cached and cached[0] == start:
+        command_cache_stats['hits'] += 1
+        return cached[1]
+    command_cache_stats['misses'] += 1
+    try:
+        cmdline = open('/proc/%d/cmdline' % (pid), 'r').read()
+    except IOError:
+        return ""
+    # Arguments are NUL-separated; keep the result on one log line like ps does.
+    process_cmd = ' '.join(cmdline.replace('\n', ' ').split('\0')).strip()
+    command_cache[pid] = (start, process_cmd)
+    return process_cmd
+
+def log_window(window):
+    """Log the process and title of window, through the debouncer if there is one."""
+    process_cmd = get_process_cmd(window.get_pid())
+    if title_debouncer:
+        title_debouncer.submit(window.get_pid(), process_cmd, window.get_name(), datetime.datetime.now())
+    else:
+        monitor(process_cmd, window.get_name())
+
 def window_name_changed(window):
     if Wnck.Screen.get_default().get_active_window() != window:
         return
-    process_cmd = ps('-p', window.get_pid(), '-o', 'cmd', 'h').strip()
-    monitor(process_cmd, window.get_name())
+    log_window(window)
 
 def application_closed(screen, application):
     global registered_windows
     logger.debug("pid %d closed:" % (application.get_pid()))
     logger.debug("  Deregistering windows: %s" % ([w.get_name() for w in application.get_windows()]))
     registered_windows -= frozenset(application.get_windows())
+    command_cache.pop(application.get_pid(), None)
+    if title_debouncer:
+        title_debouncer.forget(application.get_pid())
+    logger.debug("Command cache: %d hits, %d misses, %d entries." % (command_cache_stats['hits'], command_cache_stats['misses'], len(command_cache)))
 
 def focus_changed(screen, prev_window):
     global registered_windows
     window = screen.get_active_window()
     if not window:
         return
-    process_cmd = ps('-p', window.get_pid(), '-o', 'cmd', 'h').strip()
-    monitor(process_cmd, window.get_name())
+    log_window(window)
     if window not in registered_windows:
     #and process_cmd.split()[0].split('/')[-1] == "google-chrome":
         window.connect("name-changed", window_name_changed)
         registered_windows.add(window)
 
-def get_idle_time():
+# X display and XScreenSaverInfo kept open for the daemon's lifetime.
+idle_query = None
+
+def open_idle_query():
+    global idle_query
     xlib = ctypes.cdll.LoadLibrary( 'libX11.so')
+    xlib.XOpenDisplay.restype = ctypes.c_void_p
+    xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+    xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+    xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+    xlib.XFree.argtypes = [ctypes.c_void_p]
     dpy = xlib.XOpenDisplay( os.environ['DISPLAY'])
+    if not dpy:
+        raise RuntimeError, "unable to open display %s" % (os.environ['DISPLAY'])
     root = xlib.XDefaultRootWindow( dpy)
     xss = ctypes.cdll.LoadLibrary( 'libXss.so')
     xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(XScreenSaverInfo)
+    xss.XScreenSaverQueryInfo.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XScreenSaverInfo)]
     xss_info = xss.XScreenSaverAllocInfo()
+    idle_query = (xlib, xss, dpy, root, xss_info)
+
+def close_idle_query():
+    global idle_query
+    if idle_query:
+        xlib, xss, dpy, root, xss_info = idle_query
+        xlib.XFree(xss_info)
+        xlib.XCloseDisplay(dpy)
+        idle_query = None
+
+def get_idle_time():
+    if not idle_query:
+        open_idle_query()
+    xlib, xss, dpy, root, xss_info = idle_query
     xss.XScreenSaverQueryInfo( dpy, root, xss_info)
     return xss_info.contents.idle/1000.
 
 def check_idle():
     if config['idle']:
-        if get_idle_time() > config['idle']['time']:
+        idle_time = get_idle_time()
+        if idle_time > config['idle']['time']:
             logger.debug("Exceeded idle time.")
-            config['idle']['action'](get_idle_time())
+            config['idle']['action'](idle_time)
     return True
 
+# Seconds between checks for the user's return once they have gone idle.
+idle_recheck = 15
+was_idle = False
+
+def watch_idle():
+    """Check idle time, then sleep until the threshold could next be crossed.
+    
+    Unlike check_idle(), the idle action fires once per idle period, and no
+    time is spent polling while the user is active.
+    """
+    global was_idle
+    idle_time = get_idle_time()
+    if idle_time > config['idle']['time']:
+        if not was_idle:
+            logger.debug("Became idle.")
+            was_idle = True
+            config['idle']['action'](idle_time)
+        delay = idle_recheck
+    else:
+        if was_idle:
+            logger.debug("Became active.")
+            was_idle = False
+        delay = config['idle']['time'] - idle_time + 1
+    GLib.timeout_add(int(delay*1000), watch_idle)
+    return False
+
+# The lock file, flock()ed for as long as this process holds the timecard.
+lock_file = None
+
 def get_lock(lockfilename):
-    if not os.path.isfile(lockfilename):
-        return None
+    """Return the pid of the timecard holding the lock, or None if it isn't held."""
     try:
-        pid = int(open(lockfilename, 'r').read().strip())
-    except ValueError:
+        f = open(lockfilename, 'r')
+    except IOError:
         return None
-    return pid
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            # Left behind by a timecard that didn't exit cleanly.
+            return None
+        try:
+            return int(f.read().strip())
+        except ValueError:
+            return None
 
 def lock_timecard(pid, lockfilename):
-    if not get_lock(lockfilename):
-        open(lockfilename, 'w').write(str(pid))
-        return True
-    else:
-        return False
+    """Take the lock for pid. It is held until release_lock() or this process exits."""
+    global lock_file
+    while True:
+        f = open(lockfilename, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(lockfilename).st_ino:
+                break
+        except OSError:
+            pass
+        # Locked a file that release_lock() removed in the meantime.
+        f.close()
+    f.seek(0)
+    f.truncate()
+    f.write(str(pid))
+    f.flush()
+    lock_file = f
+    return True
 
 def release_lock(lockfilename):
-    if get_lock(lockfilename) == os.getpid():
-        os.remove(lockfilename)
-        return True
-    else:
+    global lock_file
+    if lock_file is None:
         return False
+    os.remove(lockfilename)
+    lock_file.close()
+    lock_file = None
+    return True
 
 def format_timestamp(dt, compact=False):
     if compact:
@@ -271,6 +534,7 @@ def parse_timerange(timerange, last_paid=None):
                 continue
             except ValueError:
                 pass
+            from dateutil import parser as dateparser
             try:
                 timestamp_range.append(dateparser.parse(item))
             except ValueError:
@@ -281,47 +545,132 @@ def parse_timerange(timerange, last_paid=None):
     return timestamp_range
         
 
-def notify(title, notification, timeout=Notify.EXPIRES_DEFAULT):
+def notify(title, notification, timeout=None):
+    if timeout is None:
+        timeout = Notify.EXPIRES_DEFAULT
     n = Notify.Notification.new(title, notification, 'dialog-information')
     n.set_timeout(timeout)
     n.show()
     #GLib.timeout_add_seconds(config['screenshots']['notify'], lambda: n.close() and False)
     return True
 
+log_writer = None
+screenshot_pipeline = None
+control_server = None
+title_debouncer = None
+
+def open_log_writer():
+    """Open a long-lived writer for the configured storage backend."""
+    if config['storage'] == 'sqlite':
+        import sqlitelog
+        return sqlitelog.SqliteLog(config['database'])
+    elif config['storage'] == 'binary':
+        import binlog
+        return binlog.BinaryLogWriter(config['logfile'])
+    else:
+        return timelog.LogWriter(config['logfile'], config['writer']['buffer'], config['writer']['delay'], config['writer']['fsync'])
+
+def flush_log():
+    if log_writer:
+        log_writer.flush()
+    return True
+
+def append_log(line):
+    """Append a line to the log using the configured storage backend."""
+    if log_writer:
+        log_writer.append(line)
+    elif config['storage'] == 'sqlite':
+        import sqlitelog
+        db = sqlitelog.SqliteLog(config['database'])
+        db.append(line)
+        db.close()
+    elif config['storage'] == 'binary':
+        import binlog
+        writer = binlog.BinaryLogWriter(config['logfile'])
+        writer.append(line)
+        writer.close()
+    else:
+        f = open(config['logfile'], 'a')
+        print >>f, line
+        f.close()
+
 def start_log():
-    f = open(config['logfile'], 'a')
-    print >>f, "-- Starting log at %s --" % (get_current_timestamp())
+    append_log("-- Starting log at %s --" % (get_current_timestamp()))
     logger.debug("-- Starting log at %s --", get_current_timestamp())
-    f.close()
     
+def flush_titles():
+    """Log a title change still settling, so entries stay in time order."""
+    if title_debouncer:
+        title_debouncer.flush()
+
 def write_note(note):
-    f = open(config['logfile'], 'a')
-    print >>f, "%s -- [Note] %s" % (get_current_timestamp(), note)
-    f.close()
+    flush_titles()
+    append_log("%s -- [Note] %s" % (get_current_timestamp(), note))
+    flush_log()
 
 def write_manual_adjustment(td):
-    f = open(config['logfile'], 'a')
-    print >>f, "%s -- [Manual Adjustment] %d" % (get_current_timestamp(), td.seconds)
-    f.close()
+    flush_titles()
+    append_log("%s -- [Manual Adjustment] %d" % (get_current_timestamp(), int(td.total_seconds())))
+
+last_window = (None, None)
 
-def monitor(command, window_name):
-    f = open(config['logfile'], 'a')
-    print >>f, "%s -- %s ::: %s" % (get_current_timestamp(), command, window_name)
-    logger.debug("%s -- %s ::: %s" % (get_current_timestamp(), command, window_name))
-    f.close()
+def monitor(command, window_name, timestamp=None):
+    global last_window
+    import stats
+    stats.count('events.window')
+    last_window = (command, window_name)
+    timestamp = format_timestamp(timestamp or datetime.datetime.now())
+    append_log("%s -- %s ::: %s" % (timestamp, command, window_name))
+    logger.debug("%s -- %s ::: %s" % (timestamp, command, window_name))
 
 def close_log():
     global args
-    f = open(config['logfile'], 'a')
-    print >>f, "-- Closing log at %s --" % (get_current_timestamp())
+    flush_titles()
+    append_log("-- Closing log at %s --" % (get_current_timestamp()))
     logger.debug("-- Closing log at %s --", get_current_timestamp())
-    f.close()
+    if log_writer:
+        log_writer.flush()
+
+def update_rollup():
+    """Add the spans closed since the last update to the log's rollup.
+
+    Only reports update it, so stopping or submitting never waits on it.
+    """
+    import rollup
+    import segments
+    if config['storage'] != 'text' or not config['rollups']:
+        return None
+    logfile = config['logfile']
+    try:
+        older = [segments.segment_file(logfile, entry) for entry in segments.load_manifest(logfile)['segments']]
+        return rollup.update(logfile, older)
+    except Exception as e:
+        # The report falls back to reading the spans.
+        logger.warning("Could not update the rollup of %s: %s" % (logfile, e))
+        return None
+
+def roll_log():
+    """Move the live log into a new pay-period segment."""
+    import segments
+    if config['storage'] == 'sqlite':
+        return None
+    spans, adjustments, last_paid = load_spans()
+    if last_paid == datetime.datetime(1900, 1, 1):
+        last_paid = None
+    return segments.roll(config['logfile'], spans, adjustments, last_paid, config['segments'].get('compress', False))
 
 def stop_monitoring(signum, frame):
     if signum in (signal.SIGTERM, signal.SIGINT) and args.verbose >= 2:
         logger.debug("Got %s." % ("SIGTERM" if signum==signal.SIGTERM else "SIGINT"))
     if signum in (signal.SIGTERM, signal.SIGINT):
         close_log()
+        if log_writer:
+            log_writer.close()
+        close_idle_query()
+        if screenshot_pipeline:
+            screenshot_pipeline.close()
+        if control_server:
+            control_server.close()
         if release_lock(config['lockfile']):
             sys.exit(0)
         else:
@@ -332,10 +681,15 @@ def stop_monitoring(signum, frame):
 # Commands
 
 def command_start(args):
+    import segments
     if get_lock(config['lockfile']):
         logger.error("Timecard is already locked.")
         sys.exit(1)
     
+    if config['segments'] and segments.needs_roll(config['logfile'], config['segments'].get('max_size'), config['segments'].get('monthly', False)):
+        roll_log()
+    
+    import_gui()
     if args.verbose >= 2:
         # Debug mode: -vv
         if not lock_timecard(os.getpid(), config['lockfile']):
@@ -345,25 +699,119 @@ def command_start(args):
         # Don't fork a new process for the child.
         run_child(args)
     else:
+        # The child takes the lock itself, then tells the parent if it got it.
+        ready, ready_write = os.pipe()
         pid = os.fork()
         if pid > 0:
             logger.info("Parent reports child pid=%d", pid)
-            if not lock_timecard(pid, config['lockfile']):
-                os.kill(pid, signal.SIGTERM)
+            os.close(ready_write)
+            if os.read(ready, 1) != '1':
                 logger.error("Unable to create lock file.")
                 sys.exit(1)
             print "Clocked in at %s." % (get_current_timestamp())
             sys.exit(0)
         else:
+            os.close(ready)
+            locked = lock_timecard(os.getpid(), config['lockfile'])
+            os.write(ready_write, '1' if locked else '0')
+            os.close(ready_write)
+            if not locked:
+                os._exit(1)
             run_child(args)
 
+def control_note(request):
+    write_note(request['note'])
+    return {'time': get_current_timestamp()}
+
+def control_manual(request):
+    write_manual_adjustment(datetime.timedelta(seconds=request['seconds']))
+    return {'time': get_current_timestamp()}
+
+def control_submit(request):
+    close_log()
+    submit_log()
+    start_log()
+    if title_debouncer:
+        title_debouncer.reset()
+    if last_window[0] is not None:
+        # Carry the current window over into the new span.
+        monitor(*last_window)
+    flush_log()
+    return {'time': get_current_timestamp()}
+
+def control_archive(request):
+    import segments
+    # The client has compressed the closed part already; only cut it here.
+    logfile = config['logfile']
+    flush_log()
+    stat = os.stat(logfile)
+    if stat.st_ino != request['inode'] or stat.st_size < request['end']:
+        raise RuntimeError, "%s was replaced while it was being archived" % (logfile,)
+    return {'entry': segments.drop_closed(logfile, request['end'], request['entry'])}
+
+def control_stop(request):
+    if request.get('note'):
+        write_note(request['note'])
+    # Reply first; shut down through the SIGTERM handler once this returns.
+    GLib.idle_add(lambda: os.kill(os.getpid(), signal.SIGTERM) and False)
+    return {'time': get_current_timestamp()}
+
+def control_flush(request):
+    flush_log()
+
+def control_status(request):
+    import stats
+    return {
+        'pid': os.getpid(),
+        'started': format_timestamp(datetime.datetime.fromtimestamp(stats.started)),
+        'logfile': os.path.abspath(config['logfile']),
+        'command': last_window[0],
+        'window': last_window[1],
+        'idle': get_idle_time() if config['idle'] else None,
+        'screenshots': bool(screenshot_pipeline)
+    }
+
+def control_screenshot(request):
+    if not screenshot_pipeline:
+        raise RuntimeError, "screenshots are not enabled"
+    filepath = os.path.join(config['screenshots']['directory'], get_current_timestamp(True))
+    screenshot_pipeline.take_screenshot(filepath, target=config['screenshots']['type'])
+    return {'path': filepath}
+
+def control_stats(request):
+    import stats
+    return {'stats': stats.snapshot()}
+
+control_handlers = {
+    'note': control_note,
+    'manual': control_manual,
+    'submit': control_submit,
+    'archive': control_archive,
+    'stop': control_stop,
+    'flush': control_flush,
+    'status': control_status,
+    'screenshot': control_screenshot,
+    'stats': control_stats
+}
+
 def run_child(args):
     # Child process - this will do the monitoring
-    # Give the parent a chance to do last checks and kill us if needed.
-    global logger
+    global logger, log_writer, screenshot_pipeline, control_server, title_debouncer
+    global window_name_changed, focus_changed, check_idle, watch_idle, flush_log, append_log
+    import control
+    import debounce
+    import stats
     logger.debug("Child started.")
-    time.sleep(2)
+    # Time the callbacks only here; other commands never load stats.
+    window_name_changed = stats.timed('window_name_changed')(window_name_changed)
+    focus_changed = stats.timed('focus_changed')(focus_changed)
+    check_idle = stats.timed('check_idle')(check_idle)
+    watch_idle = stats.timed('watch_idle')(watch_idle)
+    flush_log = stats.timed('log.flush')(flush_log)
+    append_log = stats.timed('log.append')(append_log)
+    log_writer = open_log_writer()
     start_log()
+    flush_log()
     
     Notify.init('Timecard')
     
@@ -374,22 +822,70 @@ def run_child(args):
     if args.verbose >= 2:
         signal.signal(signal.SIGINT, stop_monitoring)
     
+    control_server = control.ControlServer(config['socket'], control_handlers)
+    GLib.io_add_watch(control_server.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, control_server.handle)
+    stats.gauges['command_cache.entries'] = lambda: len(command_cache)
+    stats.gauges['command_cache.hits'] = lambda: command_cache_stats['hits']
+    stats.gauges['command_cache.misses'] = lambda: command_cache_stats['misses']
+    stats.gauges['windows.registered'] = lambda: len(registered_windows)
+    
     # Set up events
+    if config['titles']:
+        title_debouncer = debounce.TitleDebouncer(monitor, lambda delay, callback: GLib.timeout_add(int(delay*1000), callback), config['titles']['settle'], config['titles']['rate'])
     screen = Wnck.Screen.get_default()
     screen.connect("active-window-changed", focus_changed)
     screen.connect("application-closed", application_closed)
     if config['screenshots']:
+        screenshot_pipeline = screenshot.ScreenshotPipeline(config['screenshots'].get('workers', 1), config['screenshots'].get('queue', 4), config['screenshots'].get('dedupe'))
+        stats.gauges['screenshots.pending'] = lambda: len(screenshot_pipeline.pending)
+        take_screenshot = stats.timed('take_screenshot')(screenshot_pipeline.take_screenshot)
         if config['screenshots']['notify']:
             GLib.timeout_add_seconds(config['screenshots']['interval'], notify, "Screenshot", "Screenshot will be taken in %d seconds..." % (config['screenshots']['notify']), (config['screenshots']['notify']-1)*1000)
-            GLib.timeout_add_seconds(config['screenshots']['notify'], lambda: GLib.timeout_add_seconds(config['screenshots']['interval'], screenshot.take_screenshot, lambda: os.path.join(config['screenshots']['directory'], get_current_timestamp(True)), target=config['screenshots']['type']) and False)
+            GLib.timeout_add_seconds(config['screenshots']['notify'], lambda: GLib.timeout_add_seconds(config['screenshots']['interval'], take_screenshot, lambda: os.path.join(config['screenshots']['directory'], get_current_timestamp(True)), target=config['screenshots']['type']) and False)
         else:
-            GLib.timeout_add_seconds(config['screenshots']['interval'], screenshot.take_screenshot, lambda: os.path.join(config['screenshots']['directory'], get_current_timestamp(True)), target=config['screenshots']['type'])
-    GLib.timeout_add_seconds(15, check_idle)
+            GLib.timeout_add_seconds(config['screenshots']['interval'], take_screenshot, lambda: os.path.join(config['screenshots']['directory'], get_current_timestamp(True)), target=config['screenshots']['type'])
+    if config['idle'] and config['idle'].get('mode') == 'transition':
+        watch_idle()
+    else:
+        GLib.timeout_add_seconds(15, check_idle)
+    GLib.timeout_add_seconds(config['writer']['delay'], flush_log)
     
     logger.debug("Going into main loop.")
     Gtk.main()
 
+def daemon_request(command, timeout=5, **fields):
+    """Send a command to the running timecard. Returns None if none is listening."""
+    import control
+    if not get_lock(config['lockfile']):
+        return None
+    try:
+        reply = control.request(config['socket'], command, timeout, **fields)
+    except (socket.error, ValueError) as e:
+        logger.info("No control socket at %s: %s", config['socket'], e)
+        return None
+    if not reply.get('ok'):
+        logger.error("Timecard could not %s: %s", command, reply.get('error'))
+        sys.exit(1)
+    return reply
+
+def with_lock(func, *args):
+    """Run func with the timecard's lock held, when no timecard is running.
+
+    A timecard that holds the lock but doesn't answer may still be writing
+    to the log, so this exits with an error instead.
+    """
+    if not lock_timecard(os.getpid(), config['lockfile']):
+        logger.error("Timecard is running, but not answering on %s." % (config['socket'],))
+        sys.exit(1)
+    try:
+        return func(*args)
+    finally:
+        release_lock(config['lockfile'])
+
 def command_stop(args):
+    if daemon_request('stop', note=args.note):
+        print "Clocked out at %s." % (get_current_timestamp())
+        return
     pid = get_lock(config['lockfile'])
     if not pid:
         logger.error("Could not get a valid PID from lock file.")
@@ -401,73 +897,388 @@ def command_stop(args):
     print "Clocked out at %s." % (datetime.datetime.now().strftime("%H:%M:%S, %a %b %d, %Y"))
 
 def command_note(args):
-    write_note(args.note)
+    if not daemon_request('note', note=args.note):
+        with_lock(write_note, args.note)
     print "Note saved at %s." % (get_current_timestamp())
 
-def get_spans(lines):
-    spans = []
-    adjustments = []
-    closed = True
-    last_paid = datetime.datetime(1900, 1, 1)
-    for line in lines:
-        logger.debug(line)
-        #if " -- " not in line:
-        #    logger.debug('" -- " not found in "%s"' % (line))
-        #    continue
-        timestamp = dateparser.parse(line[line.find(':')-2:line.find(" --")])
-        if "[Note]" in line and "[submitted]" in line.lower() and timestamp > last_paid:
-            last_paid = timestamp
-        elif "[Manual Adjustment]" in line:
-            seconds = int(line[line.find(']')+2:].strip())
-            adjustments.append((timestamp, seconds))
-            logger.debug("Added %d to adjustments." % seconds)
-        if closed and not line.startswith("-- Starting"):
-            continue
-        elif line.startswith("-- Starting"):
-            logger.debug("Starting at %s" % (timestamp))
-            spans.append([(timestamp, line)])
+def command_status(args):
+    reply = daemon_request('status')
+    if not reply:
+        print "Not clocked in."
+        return
+    print "Clocked in since %s (pid %d), logging to %s." % (reply['started'], reply['pid'], reply['logfile'])
+    if reply['window'] is not None:
+        print "Current window: %s ::: %s" % (reply['command'], reply['window'])
+    if reply['idle'] is not None:
+        print "Idle for %d seconds." % (reply['idle'])
+
+def command_screenshot(args):
+    reply = daemon_request('screenshot')
+    if not reply:
+        logger.error("Timecard is not running.")
+        sys.exit(1)
+    print "Screenshot queued for %s." % (reply['path'])
+
+def get_spans(events, spans=None, adjustments=None, last_paid=None):
+    """Group a stream of Events into clocked-in spans.
+    
+    Each span is kept as [first_event, last_event] so memory use does not
+    grow with the number of window events in it. Pass the results of an
+    earlier call back in to continue parsing where it left off.
+    """
+    spans = spans if spans is not None else []
+    adjustments = adjustments if adjustments is not None else []
+    last_paid = last_paid or datetime.datetime(1900, 1, 1)
+    closed = not spans or spans[-1][-1].kind == timelog.CLOSE
+    for event in events:
+        if event.kind == timelog.SUBMITTED and event.timestamp > last_paid:
+            last_paid = event.timestamp
+        elif event.kind == timelog.MANUAL:
+            adjustments.append((event.timestamp, event.value))
+            logger.debug("Added %d to adjustments." % event.value)
+        if event.kind == timelog.START:
+            logger.debug("Starting at %s" % (event.timestamp))
+            spans.append([event, event])
             closed = False
-        elif line.startswith("-- Closing"):
-            spans[-1].append((timestamp, line))
-            closed = True
+        elif closed:
+            continue
         else:
-            spans[-1].append((timestamp, line[line.find(" -- ")+4:line.find(" ::: ")], line[line.find(" ::: "):]))
+            spans[-1][-1] = event
+            closed = event.kind == timelog.CLOSE
     return (spans, adjustments, last_paid)
 
+def load_spans(end=None):
+    """Parse the log into spans, resuming from the saved checkpoint if possible.
+
+    end is the offset to parse up to, by default its last complete line.
+    """
+    logfile = config['logfile']
+    if end is None:
+        end = timelog.complete_length(logfile)
+    checkpoint = timelog.load_checkpoint(logfile) if config['checkpoint'] else None
+    if checkpoint and checkpoint['offset'] > end:
+        # Saved by a later read; its spans go past end.
+        checkpoint = None
+    if checkpoint:
+        offset = checkpoint['offset']
+        spans, adjustments, last_paid = checkpoint['spans'], checkpoint['adjustments'], checkpoint['last_paid']
+        logger.debug("Resuming from checkpoint at offset %d.", offset)
+    else:
+        offset = 0
+        spans, adjustments, last_paid = None, None, None
+    spans, adjustments, last_paid = get_spans(timelog.read_events(logfile, offset, end), spans, adjustments, last_paid)
+    if config['checkpoint'] and (not checkpoint or end != offset):
+        timelog.save_checkpoint(logfile, end, spans, adjustments, last_paid, checkpoint)
+    return (spans, adjustments, last_paid)
+
+def find_last_paid(manifest):
+    """Latest [submitted] marker in the live log or any rolled segment."""
+    import segments
+    live = timelog.find_last_paid(config['logfile']) if os.path.exists(config['logfile']) else None
+    return max(live, segments.last_paid(manifest), datetime.datetime(1900, 1, 1), key=lambda d: d or datetime.datetime.min)
+
+def get_classifier():
+    """Build the project classifier from the config, exiting if its rules are invalid."""
+    import classify
+    try:
+        return classify.Classifier.from_config(config['projects'])
+    except ValueError as e:
+        logger.error("Invalid projects config: %s" % (e,))
+        sys.exit(1)
+
+def accumulate_logs(manifest, start_time=None, end_time=None, jobs=1, pairs=False):
+    """analysis.accumulate() over the segments overlapping the range and the live log."""
+    import analysis
+    import segments
+    logfile = config['logfile']
+    # Only the segments overlapping the range need to be read.
+    paths = [segments.segment_file(logfile, entry) for entry in segments.overlapping(manifest, start_time, end_time)]
+    if os.path.exists(logfile):
+        paths.append(logfile)
+    histograms = ({}, {}, {})
+    for path in paths:
+        if start_time is not None:
+            start, end = timelog.range_offsets(path, start_time, end_time)
+        else:
+            start, end = 0, None
+        if jobs > 1:
+            partials = analysis.parallel_accumulate(path, jobs, start, end, start_time, end_time, pairs)
+        else:
+            partials = analysis.columnar_accumulate(timelog.read_events(path, start, end), start_time, end_time, pairs)
+        for histogram, partial in zip(histograms, partials):
+            analysis.merge(histogram, partial)
+    return histograms
+
+def project_totals(classifier, start_time=None, end_time=None):
+    """Time per project over the range, from the window events in it."""
+    import segments
+    if config['storage'] == 'sqlite':
+        import sqlitelog
+        db = sqlitelog.SqliteLog(config['database'])
+        pair_histogram = db.pair_histogram(start_time, end_time)
+        db.close()
+    else:
+        commands, windows, pair_histogram = accumulate_logs(segments.load_manifest(config['logfile']), start_time, end_time, pairs=True)
+    return classifier.totals(pair_histogram)
+
+def raw_days(manifest, start_time, end_time, closed_end):
+    """Day records read straight from the logs, clipped to the range.
+
+    Only the closed part of the live log, up to closed_end, is read.
+    """
+    import rollup
+    import segments
+    logfile = config['logfile']
+    sources = [segments.segment_file(logfile, entry) for entry in segments.overlapping(manifest, start_time, end_time)]
+    if closed_end:
+        sources.append(logfile)
+    days = {}
+    for path in sources:
+        start, end = timelog.range_offsets(path, start_time, end_time)
+        if path == logfile:
+            start, end = min(start, closed_end), closed_end if end is None else min(end, closed_end)
+        rollup.merge(days, rollup.accumulate(timelog.read_events(path, start, end), start_time, end_time)[0])
+    return days
+
+def rollup_days(timerange):
+    """Day records over the range from the rollup, or None if rollups are off.
+
+    Returns (days, start_time, end_time).
+    """
+    import rollup
+    import segments
+    logfile = config['logfile']
+    manifest = segments.load_manifest(logfile)
+    counted = update_rollup()
+    if counted is None:
+        return None
+    days = {}
+    closed_end = timelog.closed_length(logfile) if os.path.exists(logfile) else 0
+    if timerange:
+        start_time, end_time = parse_timerange(timerange, find_last_paid(manifest))
+        first, last = start_time.strftime("%Y-%m-%d"), end_time.strftime("%Y-%m-%d")
+        # Whole days come from the rollup; the partial days at the edges are read raw.
+        for key, record in counted['days'].iteritems():
+            if first < key < last:
+                rollup.merge(days, {key: record})
+        rollup.merge(days, raw_days(manifest, start_time, min(end_time, datetime.datetime.combine(start_time.date(), datetime.time()) + datetime.timedelta(days=1)), closed_end))
+        if first != last:
+            rollup.merge(days, raw_days(manifest, datetime.datetime.combine(end_time.date(), datetime.time()), end_time, closed_end))
+    else:
+        start_time, end_time = None, None
+        rollup.merge(days, counted['days'])
+    if os.path.exists(logfile):
+        # The open span isn't in the rollup yet.
+        rollup.merge(days, rollup.accumulate(timelog.read_events(logfile, closed_end), start_time, end_time)[0])
+    return (days, start_time, end_time)
+
+def summarize_periods(args):
+    """summarize --by: totals per day, week or month.
+
+    Text logs are summarized from their rollup. Other logs, or text logs
+    with rollups turned off, are added up from their spans.
+    """
+    import rollup
+    result = rollup_days(args.timerange) if config['storage'] == 'text' else None
+    if result is None:
+        spans, adjustments, start_time, end_time = collect_spans(args.timerange)
+        result = (rollup.span_days(spans, adjustments, start_time, end_time), start_time, end_time)
+    days, start_time, end_time = result
+    label = {'day': "%a %Y-%m-%d", 'week': "Week of %Y-%m-%d", 'month': "%B %Y"}[args.by]
+    total_hours = 0.0
+    for period, record in sorted(rollup.periods(days, args.by).items()):
+        hours = (record['seconds'] + record['adjustments'])/3600.
+        total_hours += hours
+        print "%s\n  -- Total %.3f hours in %d span%s." % (period.strftime(label), hours, record['spans'], '' if record['spans'] == 1 else 's')
+        if record['adjustments']:
+            print "     including manual adjustments of %.2f hours." % (record['adjustments']/3600.)
+        for command, seconds in sorted(record['commands'].items(), key=lambda c: (-c[1], c[0]))[:3]:
+            print "     %8.3f hours\t%s" % (seconds/3600., command)
+    if not days:
+        print "No time worked."
+    elif args.timerange:
+        print "\nTotal time worked from %s to %s:\n    %.3f hours" % (format_timestamp(start_time, True), format_timestamp(end_time, True), total_hours)
+    else:
+        print "\nTotal time worked:\n    %.3f hours" % (total_hours)
+
+def collect_spans(timerange=None):
+    """Spans and adjustments from the database, or the log and its segments.
+
+    With a time range, spans that can't overlap it may be left out.
+    Returns (spans, adjustments, start_time, end_time), the times None
+    without a range.
+    """
+    import segments
+    start_time, end_time = None, None
+    if config['storage'] == 'sqlite':
+        import sqlitelog
+        db = sqlitelog.SqliteLog(config['database'])
+        last_paid = db.last_paid() or datetime.datetime(1900, 1, 1)
+        if timerange:
+            start_time, end_time = parse_timerange(timerange, last_paid)
+            spans = db.spans(start_time, end_time)
+        else:
+            spans = db.spans()
+        adjustments = db.adjustments()
+        db.close()
+        return (spans, adjustments, start_time, end_time)
+    manifest = segments.load_manifest(config['logfile'])
+    if timerange and not config['checkpoint']:
+        # Nothing to resume from, so only parse the part of the log in range.
+        last_paid = find_last_paid(manifest)
+        start_time, end_time = parse_timerange(timerange, last_paid)
+        spans, adjustments = [], []
+        if os.path.exists(config['logfile']):
+            offsets = timelog.range_offsets(config['logfile'], start_time, end_time)
+            spans, adjustments, _ = get_spans(timelog.read_events(config['logfile'], *offsets))
+    else:
+        if os.path.exists(config['logfile']):
+            spans, adjustments, last_paid = load_spans()
+        else:
+            spans, adjustments, last_paid = [], [], datetime.datetime(1900, 1, 1)
+        last_paid = max(last_paid, segments.last_paid(manifest) or last_paid)
+        if timerange:
+            start_time, end_time = parse_timerange(timerange, last_paid)
+    # Closed pay periods are summarized from the manifest without reading them.
+    old_spans, old_adjustments = segments.spans(segments.overlapping(manifest, start_time, end_time) if timerange else manifest['segments'])
+    return (old_spans + spans, old_adjustments + adjustments, start_time, end_time)
+
+def follow_load():
+    """Parse the log and its segments into the state kept by summarize --follow."""
+    import segments
+    logfile = config['logfile']
+    manifest = segments.load_manifest(logfile)
+    try:
+        inode = os.stat(logfile).st_ino
+    except OSError:
+        inode = None
+    if inode is not None:
+        end = timelog.complete_length(logfile)
+        spans, adjustments, last_paid = load_spans(end)
+    else:
+        end = 0
+        spans, adjustments, last_paid = [], [], datetime.datetime(1900, 1, 1)
+    old_spans, old_adjustments = segments.spans(manifest['segments'])
+    return {
+        'inode': inode,
+        'offset': end,
+        'spans': spans,
+        'adjustments': adjustments,
+        'last_paid': max(last_paid, segments.last_paid(manifest) or last_paid),
+        'old_spans': old_spans,
+        'old_adjustments': old_adjustments,
+        'coverage': None # (number of closed spans, their Coverage)
+    }
+
+def follow_update(state):
+    """Parse the lines appended to the log since the last update into state."""
+    logfile = config['logfile']
+    try:
+        stat = os.stat(logfile)
+    except OSError:
+        stat = None
+    if state is None or stat is None or stat.st_ino != state['inode'] or stat.st_size < state['offset']:
+        # Not read yet, or rolled, archived or rewritten since.
+        return follow_load()
+    end = timelog.complete_length(logfile)
+    if end > state['offset']:
+        spans, adjustments, last_paid = get_spans(timelog.read_events(logfile, state['offset'], end), state['spans'], state['adjustments'], state['last_paid'])
+        state.update(offset=end, last_paid=last_paid)
+    return state
+
+def follow_total(state, start_time=None, end_time=None):
+    """Seconds worked in the range, counting the open span as lasting until now.
+
+    Returns (seconds, the open span or None).
+    """
+    import analysis
+    spans = state['spans']
+    open_span = spans[-1] if spans and spans[-1][-1].kind != timelog.CLOSE else None
+    closed = spans[:-1] if open_span is not None else spans
+    # Closed spans don't change, so their coverage is only rebuilt when one is added.
+    count = len(state['old_spans']) + len(closed)
+    if state['coverage'] is None or state['coverage'][0] != count:
+        state['coverage'] = (count, analysis.Coverage((span[0][0], span[-1][0]) for span in state['old_spans'] + closed))
+    coverage = state['coverage'][1]
+    seconds = coverage.overlap(start_time, end_time) if start_time is not None else coverage.total()
+    if open_span is not None:
+        seconds += analysis.clipped(open_span[0][0], max(datetime.datetime.now(), open_span[-1][0]), start_time, end_time)
+    for timestamp, value in state['old_adjustments'] + state['adjustments']:
+        if start_time is None or start_time <= timestamp < end_time:
+            seconds += value
+    return (seconds, open_span)
+
+def follow_show(timerange, state, clear=False):
+    import analysis
+    # Relative ranges like today are evaluated anew on every refresh.
+    start_time, end_time = parse_timerange(timerange, state['last_paid']) if timerange else (None, None)
+    seconds, open_span = follow_total(state, start_time, end_time)
+    if clear:
+        sys.stdout.write("\033[H\033[2J")
+    if timerange:
+        print "Total time worked from %s to %s:\n    %.3f hours" % (format_timestamp(start_time, True), format_timestamp(end_time, True), seconds/3600.)
+    else:
+        print "Total time worked:\n    %.3f hours" % (seconds/3600.)
+    if open_span is not None:
+        print "Clocked in since %s\n  -- %.3f hours so far." % (format_timestamp(open_span[0][0]), analysis.clipped(open_span[0][0], datetime.datetime.now())/3600.)
+    else:
+        print "Not clocked in."
+    if not clear:
+        print
+    sys.stdout.flush()
+
+def summarize_follow(args):
+    """summarize --follow: keep the total over the range on screen as the log grows.
+
+    The parsed spans stay in memory, and only the lines appended since the
+    last refresh are read. The log is watched through inotify, falling back
+    to polling its stat. The display is refreshed at most once a second
+    while the log changes, and every follow_refresh seconds otherwise.
+    """
+    import tail
+    if config['storage'] == 'sqlite':
+        logger.error("Only text and binary logs can be followed.")
+        sys.exit(1)
+    watcher = tail.FileWatcher(config['logfile'])
+    clear = sys.stdout.isatty()
+    state = None
+    shown = 0
+    changed = True
+    try:
+        while True:
+            if changed:
+                # Let a burst of writes settle rather than refresh more than once a second.
+                delay = shown + 1 - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                state = follow_update(state)
+            follow_show(args.timerange, state, clear)
+            shown = time.time()
+            changed = watcher.wait(follow_refresh)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
 def command_summarize(args):
-    total_log = map(lambda l: l.strip(), open(config['logfile'], 'r').readlines())
-    logger.debug(len(total_log))
-    spans, adjustments, last_paid = get_spans(total_log)
+    import analysis
+    if args.follow:
+        return summarize_follow(args)
+    if args.by:
+        return summarize_periods(args)
+    classifier = get_classifier() if args.projects else None
+    spans, adjustments, start_time, end_time = collect_spans(args.timerange)
     logger.debug(len(spans))
     if args.timerange:
-        start_time, end_time = parse_timerange(args.timerange, last_paid)
         logger.debug("start_time: '%s', end_time: '%s'", start_time, end_time)
-        spans = filter(lambda s: s[0][0]>start_time, spans)
-        adjustments = filter(lambda a: a[0]>start_time, adjustments)
-    total_hours = 0.0
+        # A span counts as far as it overlaps the range, wherever it starts or ends.
+        spans = [s for s in spans if s[-1][0] > start_time and s[0][0] < end_time]
+        adjustments = [a for a in adjustments if start_time <= a[0] < end_time]
     for span in spans:
-        st_time = span[0][0]
-        e_time = span[-1][0]
-        if args.timerange:
-            if e_time < start_time or st_time > end_time:
-                logger.debug("Skipping: %s, %s, %s, %s", start_time, st_time, end_time, e_time)
-                continue
-            elif start_time > st_time and end_time < e_time:
-                # Span is completely within timerange
-                delta = end_time - start_time
-            elif st_time < start_time:
-                logger.debug("%s, %s, %s, %s", start_time, st_time, end_time, e_time)
-                delta = e_time - start_time
-            elif e_time > end_time:
-                logger.debug("%s, %s, %s, %s", start_time, st_time, end_time, e_time)
-                delta = end_time - st_time
-            else:
-                delta = e_time - st_time
-        else:
-            delta = e_time - st_time
-        hours = delta.total_seconds()/3600.
-        total_hours += hours
-        print "Worked from %s to %s\n  -- Total %.3f hours." % (format_timestamp(st_time), format_timestamp(e_time), hours)
+        hours = analysis.clipped(span[0][0], span[-1][0], start_time, end_time)/3600.
+        print "Worked from %s to %s\n  -- Total %.3f hours." % (format_timestamp(span[0][0]), format_timestamp(span[-1][0]), hours)
+    coverage = analysis.Coverage((span[0][0], span[-1][0]) for span in spans)
+    total_hours = (coverage.overlap(start_time, end_time) if args.timerange else coverage.total())/3600.
     if adjustments:
         adj_hours = sum(a[1] for a in adjustments)/60./60.
         print "Manual adjustments totaling %.2f hours." % adj_hours
@@ -476,63 +1287,164 @@ def command_summarize(args):
         print "\nTotal time worked from %s to %s:\n    %.3f hours" % (format_timestamp(start_time, True), format_timestamp(end_time, True), total_hours)
     else:
         print "\nTotal time worked from %s to %s:\n    %.3f hours" % (format_timestamp(spans[0][0][0], True), format_timestamp(spans[-1][-1][0], True), total_hours)
+    if classifier:
+        projects = project_totals(classifier, start_time, end_time)
+        print "\nTime worked per project:"
+        for project, time_len in analysis.ranked(projects):
+            print "    %8.3f hours\t%s" % (time_len.total_seconds()/3600., project)
 
 def command_analyze(args):
-    raw_log = map(lambda l: l.strip(), open(config['logfile'], 'r').readlines())
-    raw_log = filter(lambda l: len(l)>0, raw_log)
-    last_paid = datetime.datetime(datetime.MINYEAR, 1, 1)
-    parsed_log = []
-    for line in raw_log:
-        if line.startswith("-- Starting log"):
-            parsed_log.append([])
-            segment = parsed_log[-1]
-            continue
-        elif line.startswith("-- Closing log"):
-            segment.append((dateparser.parse(line[len("-- Closing log at "):-3]), "END", ""))
-            continue
-        
-        timestamp, info = line.split(' -- ', 1)
-        if info.startswith("[Note]"):
-            if "[submitted]" in line.lower() and timestamp > last_paid:
-                last_paid = timestamp
-            continue
-        command, window_name = info.split(' ::: ', 1)
-        segment.append((dateparser.parse(timestamp), command, window_name))
-    command_histogram = {}
-    window_histogram = {}
-    for segment in parsed_log:
-        for i in xrange(len(segment)-1):
-            entry = segment[i]
-            next_entry = segment[i+1]
-            if entry[1] == "END":
-                break
-            cmd_time_accumulated = command_histogram.get(entry[1], datetime.timedelta(0))
-            cmd_time_accumulated += next_entry[0] - entry[0]
-            command_histogram[entry[1]] = cmd_time_accumulated
-            win_time_accumulated = window_histogram.get(entry[2], datetime.timedelta(0))
-            win_time_accumulated += next_entry[0] - entry[0]
-            window_histogram[entry[2]] = win_time_accumulated
+    import analysis
+    import segments
+    classifier = get_classifier() if config['projects'] else None
+    if config['storage'] == 'sqlite':
+        import sqlitelog
+        db = sqlitelog.SqliteLog(config['database'])
+        if args.timerange:
+            start_time, end_time = parse_timerange(args.timerange, db.last_paid() or datetime.datetime(1900, 1, 1))
+        else:
+            start_time, end_time = None, None
+        command_histogram = db.histogram('command', start_time, end_time)
+        window_histogram = db.histogram('window', start_time, end_time)
+        pair_histogram = db.pair_histogram(start_time, end_time) if classifier else {}
+        db.close()
+    else:
+        manifest = segments.load_manifest(config['logfile'])
+        if args.timerange:
+            start_time, end_time = parse_timerange(args.timerange, find_last_paid(manifest))
+        else:
+            start_time, end_time = None, None
+        command_histogram, window_histogram, pair_histogram = accumulate_logs(manifest, start_time, end_time, args.jobs, classifier is not None)
     print "Time spent per command:"
-    for command, time_len in sorted(command_histogram.items(), cmp=lambda e1, e2: cmp(e1[1], e2[1]), reverse=True):
+    for command, time_len in analysis.ranked(command_histogram, args.top):
         print "%s\t%s" % (time_len, command)
     print ""
     print "Time spent per window name:"
-    for win_name, time_len in sorted(window_histogram.items(), cmp=lambda e1, e2: cmp(e1[1], e2[1]), reverse=True):
+    for win_name, time_len in analysis.ranked(window_histogram, args.top):
         print "%s\t%s" % (time_len, win_name)
+    if classifier:
+        print ""
+        print "Time spent per project:"
+        for project, time_len in analysis.ranked(classifier.totals(pair_histogram), args.top):
+            print "%s\t%s" % (time_len, project)
 
 def command_manual(args):
     timerange = parse_timerange(args.time)
     td = timerange[1]-timerange[0]
-    write_manual_adjustment(td)
+    if not daemon_request('manual', seconds=int(td.total_seconds())):
+        with_lock(write_manual_adjustment, td)
 
 def command_submit(args):
-    close_log()
-    write_note("[submitted]")
-    open_log()
+    # A running timecard closes, submits and reopens its own log.
+    if not daemon_request('submit'):
+        with_lock(submit_log)
     print "Hours submitted at %s." % (get_current_timestamp())
 
+def submit_log():
+    """Mark the hours so far as submitted, rolling the log if segments are on."""
+    write_note("[submitted]")
+    if config['segments']:
+        roll_log()
+
+def compress_closed(codec='gz'):
+    """Compress the closed spans of the live log into a new segment file.
+
+    Returns (the length of the log compressed, the segment's manifest entry
+    or None if there was nothing to archive).
+    """
+    import segments
+    logfile = config['logfile']
+    end = timelog.closed_length(logfile)
+    spans, adjustments, last_paid = get_spans(timelog.read_events(logfile, 0, end))
+    if last_paid == datetime.datetime(1900, 1, 1):
+        last_paid = None
+    return (end, segments.compress_closed(logfile, end, spans, adjustments, last_paid, codec))
+
+def archive_log(codec='gz'):
+    """Compress the closed spans of the live log into a segment.
+
+    Nothing may be appended to the log meanwhile, so this only runs with
+    the timecard's lock held. Returns the manifest entry, or None if there
+    was nothing to archive.
+    """
+    import segments
+    end, entry = compress_closed(codec)
+    if entry is None:
+        return None
+    return segments.drop_closed(config['logfile'], end, entry)
+
+def command_archive(args):
+    import archive
+    import segments
+    if config['storage'] != 'text':
+        logger.error("Only text logs can be archived.")
+        sys.exit(1)
+    codec = args.codec or (config['segments'] and config['segments'].get('compress'))
+    codec = codec if codec in archive.codecs else 'gz'
+    # The open span stays in the live log. A running timecard only appends
+    # past the closed spans, so they are compressed here, and the timecard
+    # itself then cuts them from its log.
+    if daemon_request('flush'):
+        inode = os.stat(config['logfile']).st_ino
+        end, entry = compress_closed(codec)
+        if entry:
+            reply = None
+            try:
+                reply = daemon_request('archive', end=end, inode=inode, entry=entry)
+            finally:
+                if not reply:
+                    path = segments.segment_file(config['logfile'], entry)
+                    for leftover in (path, archive.index_path(path)):
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+            if not reply:
+                logger.error("Timecard stopped while %s was being archived." % (config['logfile'],))
+                sys.exit(1)
+            entry = reply['entry']
+    else:
+        entry = with_lock(archive_log, codec)
+    if entry:
+        print "Archived %.3f hours into %s." % (entry['hours'], entry['path'])
+    else:
+        print "Nothing to archive."
+
+def command_import(args):
+    import sqlitelog
+    db = sqlitelog.SqliteLog(config['database'])
+    try:
+        count = db.import_text(args.textlog or config['logfile'])
+    except ValueError as e:
+        logger.error("Not importing: %s." % (e,))
+        sys.exit(1)
+    finally:
+        db.close()
+    print "Imported %d entries into %s." % (count, config['database'])
+
+def command_convert(args):
+    import binlog
+    if binlog.is_binary(args.source):
+        count = binlog.to_text(args.source, args.destination)
+        print "Converted %d lines to text in %s." % (count, args.destination)
+    else:
+        count = binlog.to_binary(args.source, args.destination)
+        print "Converted %d lines to binary in %s." % (count, args.destination)
+
+def command_stats(args):
+    import stats
+    reply = daemon_request('stats')
+    if not reply:
+        logger.error("Timecard is not running.")
+        sys.exit(1)
+    snapshot = reply['stats']
+    if args.json:
+        print json.dumps(snapshot, indent=1, sort_keys=True)
+    else:
+        print stats.format_snapshot(snapshot)
+
 def command_test(args):
     global config
+    test_config()
+    import_gui()
     print args
     print config
     screenshot.take_screenshot("tests/test.png", target=screenshot.ENTIRE_DESKTOP)
@@ -564,9 +1476,11 @@ def parse_all_args(argv):
     parser_start.add_argument('--screenshot-dir', help="Directory to store screenshots.")
     parser_start.add_argument('--screenshot-type', choices=screenshot_types.keys(), help='Area to restrict screenshots to.')
     parser_start.add_argument('--screenshot-interval', metavar='interval', type=int, help='Seconds between screenshots.')
+    parser_start.add_argument('--dedupe', metavar='threshold', type=float, help='Skip screenshots differing from the previous one by less than this fraction (e.g. 0.01).')
     parser_start.add_argument('-N', '--notify', metavar='warning', nargs='?', type=int, help='Notify [N] seconds before a screenshot.')
     parser_start.add_argument('-i', '--idle-time', metavar='seconds', dest='idletime', type=int, help='Time in seconds before user becomes idle.')
     parser_start.add_argument('--idle-action', choices=idle_actions.keys(), help='Action to take when idle.')
+    parser_start.add_argument('--idle-mode', choices=('poll', 'transition'), help='Poll for idleness every 15 seconds, or only check when the idle time could be reached.')
     parser_start.add_argument('-n', '--note', metavar='note', help='Add a note to this action.')
     parser_start.set_defaults(func=command_start)
     
@@ -574,16 +1488,27 @@ def parse_all_args(argv):
     parser_stop.add_argument('-n', '--note', metavar='note', help='Add a note to this action.')
     parser_stop.set_defaults(func=command_stop)
     
+    parser_status = subparsers.add_parser('status', help='Show whether the timecard is running and what it last logged.')
+    parser_status.set_defaults(func=command_status)
+    
+    parser_screenshot = subparsers.add_parser('screenshot', help='Have the running timecard take a screenshot now.')
+    parser_screenshot.set_defaults(func=command_screenshot)
+    
     parser_note = subparsers.add_parser('note', help='Add a note to an active timecard.')
     parser_note.add_argument('note', nargs='?', help='Note to be recorded.')
     parser_note.set_defaults(func=command_note)
     
     parser_summarize = subparsers.add_parser('summarize', help='Summarize the time usage in a timecard, optionally over a time range.')
     parser_summarize.add_argument('timerange', nargs='?', help='Time range to summarize. Accepts absolute dates, relative dates in *w*d*h (weeks/days/hours) format, and ranges of either or both.')
+    parser_summarize.add_argument('-p', '--projects', action='store_true', help='Also total the time per project, as classified by the projects rules in the config.')
+    parser_summarize.add_argument('-b', '--by', choices=('day', 'week', 'month'), help='Total the time per day, week or month instead of per span, from the per-day rollups.')
+    parser_summarize.add_argument('--follow', action='store_true', help='Keep the total on screen, updating it as the log grows, until interrupted.')
     parser_summarize.set_defaults(func=command_summarize)
     
     parser_analyze = subparsers.add_parser('analyze', help='More detailed analysis of time use.')
     parser_analyze.add_argument('timerange', nargs='?', help='Time range to analyze. Accepts absolute dates, relative dates in 1w2d3h (weeks/days/hours) format, and ranges of either or both.')
+    parser_analyze.add_argument('-j', '--jobs', metavar='N', type=int, default=1, help='Analyze the log in N parallel processes.')
+    parser_analyze.add_argument('-t', '--top', metavar='N', type=int, help='Only list the N longest commands, window names and projects.')
     parser_analyze.set_defaults(func=command_analyze)
     
     parser_manual = subparsers.add_parser('manual', help='Add or subtract time manually.')
@@ -593,6 +1518,23 @@ def parse_all_args(argv):
     parser_submit = subparsers.add_parser('submit', help="Submit your hours and start a new pay period.")
     parser_submit.set_defaults(func=command_submit)
     
+    parser_archive = subparsers.add_parser('archive', help="Compress the closed spans of the log, leaving the open one as plain text.")
+    parser_archive.add_argument('--codec', choices=[extension[1:] for extension in timelog.COMPRESSED_EXTENSIONS], help='Compression format. Defaults to the segments compress setting, or gz.')
+    parser_archive.set_defaults(func=command_archive)
+    
+    parser_import = subparsers.add_parser('import', help="Import a plain-text log into the SQLite database.")
+    parser_import.add_argument('textlog', nargs='?', help='Text log to import. Defaults to the time log file.')
+    parser_import.set_defaults(func=command_import)
+    
+    parser_convert = subparsers.add_parser('convert', help="Convert a log between the text and binary formats.")
+    parser_convert.add_argument('source', help='Log to convert. Binary logs become text, text logs become binary.')
+    parser_convert.add_argument('destination', help='File to write the converted log to.')
+    parser_convert.set_defaults(func=command_convert)
+    
+    parser_stats = subparsers.add_parser('stats', help="Show handler latencies, event counts and resource use of the running timecard.")
+    parser_stats.add_argument('--json', action='store_true', help='Print the raw numbers as JSON.')
+    parser_stats.set_defaults(func=command_stats)
+    
     parser_test = subparsers.add_parser('test', help='Internal test.')
     parser_test.set_defaults(func=command_test)
     
@@ -637,8 +1579,8 @@ if __name__ == "__main__":
     
     if args.display != None:
         os.environ['DISPLAY'] = args.display
-    elif not 'DISPLAY' in os.environ:
-        # If called from cron, find first display.
+    elif not 'DISPLAY' in os.environ and args.func in (command_start, command_test):
+        # If called from cron, find first display. Only needed to monitor.
         os.environ['DISPLAY'] = find_display()
     
     args.func(args)
@@ -0,0 +1,514 @@
+"""timelog.py
+
+Reading, parsing and writing of timecard log files.
+"""
+
+import os
+import time
+import datetime
+import collections
+import hashlib
+import mmap
+import json
+
+# Log timestamps are always written as "%H:%M:%S, %a %b %d, %Y", e.g.
+# "14:03:22, Mon Apr 14, 2014".
+TIMESTAMP_FORMAT = "%H:%M:%S, %a %b %d, %Y"
+TIMESTAMP_LENGTH = 26
+
+months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+weekdays = frozenset(('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'))
+
+# Consecutive log lines almost always share a date, so remember the last one.
+_last_date = (None, None)
+
+def _parse_fixed(text):
+    """Parse a timestamp in the fixed log format, or return None."""
+    global _last_date
+    if len(text) != TIMESTAMP_LENGTH or text[2] != ':' or text[5] != ':' or text[8:10] != ', ':
+        return None
+    date_text = text[10:]
+    if _last_date[0] == date_text:
+        year, month, day = _last_date[1]
+    else:
+        if date_text[3] != ' ' or date_text[7] != ' ' or date_text[10:12] != ', ':
+            return None
+        if date_text[:3] not in weekdays or date_text[4:7] not in months:
+            return None
+        try:
+            year, month, day = int(date_text[12:16]), months[date_text[4:7]], int(date_text[8:10])
+        except ValueError:
+            return None
+        _last_date = (date_text, (year, month, day))
+    try:
+        return datetime.datetime(year, month, day, int(text[0:2]), int(text[3:5]), int(text[6:8]))
+    except ValueError:
+        return None
+
+def parse_timestamp(text):
+    """Parse a log timestamp, falling back to dateutil for unknown formats."""
+    timestamp = _parse_fixed(text)
+    if timestamp is None:
+        # Rare, so don't make every command pay for importing dateutil.
+        from dateutil import parser as dateparser
+        timestamp = dateparser.parse(text)
+    return timestamp
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+def to_epoch(dt):
+    """Convert a naive log timestamp to integer seconds, ignoring time zones."""
+    delta = dt - _epoch
+    return delta.days*86400 + delta.seconds
+
+def from_epoch(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+def line_timestamp(line):
+    """Return the timestamp text embedded in a log line."""
+    return line[line.find(':')-2:line.find(" --")]
+
+# Event kinds
+START = 0 # -- Starting log at ... --
+CLOSE = 1 # -- Closing log at ... --
+WINDOW = 2 # Focus or window title change
+NOTE = 3 # [Note]
+MANUAL = 4 # [Manual Adjustment]
+SUBMITTED = 5 # [Note] [submitted]
+
+# value is the note text for NOTE/SUBMITTED and the seconds for MANUAL.
+Event = collections.namedtuple('Event', 'timestamp kind command window value')
+
+def parse_line(line):
+    """Parse a single stripped log line into an Event, or None if it isn't one."""
+    if line.startswith("-- Starting"):
+        return Event(parse_timestamp(line_timestamp(line)), START, None, None, None)
+    elif line.startswith("-- Closing"):
+        return Event(parse_timestamp(line_timestamp(line)), CLOSE, None, None, None)
+    if " -- " not in line:
+        return None
+    timestamp, info = line.split(" -- ", 1)
+    timestamp = parse_timestamp(timestamp)
+    if info.startswith("[Note]"):
+        note = info[len("[Note] "):]
+        kind = SUBMITTED if "[submitted]" in note.lower() else NOTE
+        return Event(timestamp, kind, None, None, note)
+    elif info.startswith("[Manual Adjustment]"):
+        return Event(timestamp, MANUAL, None, None, int(info[len("[Manual Adjustment]"):].strip()))
+    command, _, window_name = info.partition(" ::: ")
+    return Event(timestamp, WINDOW, command, window_name, None)
+
+def format_event(event):
+    """Render an Event as the text log line it was parsed from."""
+    timestamp = event.timestamp.strftime(TIMESTAMP_FORMAT)
+    if event.kind == START:
+        return "-- Starting log at %s --" % (timestamp)
+    elif event.kind == CLOSE:
+        return "-- Closing log at %s --" % (timestamp)
+    elif event.kind in (NOTE, SUBMITTED):
+        return "%s -- [Note] %s" % (timestamp, event.value)
+    elif event.kind == MANUAL:
+        return "%s -- [Manual Adjustment] %d" % (timestamp, event.value)
+    else:
+        return "%s -- %s ::: %s" % (timestamp, event.command, event.window)
+
+def iter_events(lines):
+    """Yield Events from an iterable of raw log lines, skipping other lines."""
+    for line in lines:
+        event = parse_line(line.strip())
+        if event is not None:
+            yield event
+
+def _lines_within(f, length):
+    """Yield the lines of f that end within its next length bytes."""
+    for line in f:
+        length -= len(line)
+        if length < 0:
+            break
+        yield line
+
+# Start of a log in the compact binary format (see binlog.py).
+BINARY_MAGIC = 'TCBLOG01'
+
+def is_binary(path):
+    """Return True if path holds a binary log rather than a text one."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    except IOError:
+        return False
+
+# Compressed archives of old logs (see archive.py).
+COMPRESSED_EXTENSIONS = ('.gz', '.xz', '.zst')
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_EXTENSIONS)
+
+def read_events(path, start=0, end=None):
+    """Stream Events from the log file at path without loading it into memory.
+    
+    Arguments:
+        path -- log file to read.
+        start -- byte offset to start reading at; must be a line boundary.
+        end -- byte offset to stop reading at, or None to read to the end.
+    """
+    if is_binary(path):
+        import binlog
+        for event in binlog.read_events(path, start, end):
+            yield event
+        return
+    elif is_compressed(path):
+        import archive
+        for event in archive.read_events(path, start, end):
+            yield event
+        return
+    with open(path, 'r') as f:
+        f.seek(start)
+        for event in iter_events(f if end is None else _lines_within(f, end - start)):
+            yield event
+
+def complete_length(path, blocksize=4096):
+    """Return the offset just past the last complete line in path."""
+    if is_binary(path):
+        import binlog
+        return binlog.complete_length(path)
+    elif is_compressed(path):
+        import archive
+        return archive.complete_length(path)
+    with open(path, 'r') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        while position > 0:
+            offset = max(0, position - blocksize)
+            f.seek(offset)
+            block = f.read(position - offset)
+            newline = block.rfind('\n')
+            if newline >= 0:
+                return offset + newline + 1
+            position = offset
+    return 0
+
+#########
+# Time range seeks
+
+def _map_log(path):
+    """Memory-map the log at path, or return None if it is empty."""
+    with open(path, 'r') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _line_start(m, position):
+    """Return the start of the first line beginning at or after position."""
+    if position <= 0:
+        return 0
+    newline = m.find('\n', position - 1)
+    return len(m) if newline < 0 else newline + 1
+
+def _line_end(m, position):
+    """Return the offset just past the line containing position."""
+    newline = m.find('\n', position)
+    return len(m) if newline < 0 else newline + 1
+
+def _timestamp_at(m, position):
+    """Return the timestamp of the first event at or after a line start."""
+    while position < len(m):
+        end = _line_end(m, position)
+        event = parse_line(m[position:end].strip())
+        if event is not None:
+            return event.timestamp
+        position = end
+    return None
+
+def _bisect(m, timestamp, after=False):
+    """Return the start of the first line stamped at (or after) timestamp.
+    
+    With after=True, lines stamped exactly at timestamp are skipped too.
+    Relies on the log being written in chronological order.
+    """
+    lo, hi = 0, len(m)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        found = _timestamp_at(m, _line_start(m, mid))
+        if found is None or found > timestamp or (found == timestamp and not after):
+            hi = mid
+        else:
+            lo = mid + 1
+    return _line_start(m, lo)
+
+def _rfind_line(m, prefix, end):
+    """Return the start of the last line before end beginning with prefix, or -1."""
+    position = m.rfind(prefix, 0, end)
+    while position > 0 and m[position-1] != '\n':
+        position = m.rfind(prefix, 0, position)
+    return position
+
+def _find_line(m, prefix, start):
+    """Return the start of the first line at or after start beginning with prefix, or -1."""
+    position = m.find(prefix, start)
+    while position > 0 and m[position-1] != '\n':
+        position = m.find(prefix, position + 1)
+    return position
+
+def range_offsets(path, start_time, end_time):
+    """Find the byte range of the log needed to cover [start_time, end_time].
+    
+    The range is widened to the "-- Starting log" line of a span straddling
+    start_time and to the "-- Closing log" line of one straddling end_time,
+    so both are seen whole by get_spans(). Returns (start, end) offsets
+    suitable for read_events().
+    """
+    if is_binary(path):
+        import binlog
+        return binlog.range_offsets(path, start_time, end_time)
+    elif is_compressed(path):
+        import archive
+        return archive.range_offsets(path, start_time, end_time)
+    m = _map_log(path)
+    if m is None:
+        return (0, 0)
+    try:
+        start = _bisect(m, start_time)
+        opening = _rfind_line(m, "-- Starting log", start)
+        if opening >= 0 and _rfind_line(m, "-- Closing log", start) < opening:
+            start = opening
+        end = _bisect(m, end_time, after=True)
+        closing = _find_line(m, "-- Closing log", end)
+        opening = _find_line(m, "-- Starting log", end)
+        if closing >= 0 and (opening < 0 or closing < opening):
+            end = _line_end(m, closing)
+        elif opening >= 0:
+            end = opening
+        else:
+            end = len(m)
+        return (start, end)
+    finally:
+        m.close()
+
+def split_offsets(path, count, start=0, end=None):
+    """Cut the byte range [start, end) of the log into about count shards.
+    
+    Cuts are only made at "-- Starting log" lines, so every log segment
+    falls entirely within one shard. Returns a list of (start, end) pairs.
+    """
+    if is_binary(path):
+        import binlog
+        return binlog.split_offsets(path, count, start, end)
+    elif is_compressed(path):
+        import archive
+        return archive.split_offsets(path, count, start, end)
+    m = _map_log(path)
+    if m is None:
+        return [(0, 0)]
+    try:
+        end = len(m) if end is None else end
+        shards = []
+        first = start
+        for i in xrange(1, count):
+            cut = _find_line(m, "-- Starting log", first + (end - first) * i // count)
+            if cut < 0 or cut >= end:
+                break
+            if cut > start:
+                shards.append((start, cut))
+                start = cut
+        shards.append((start, end))
+        return shards
+    finally:
+        m.close()
+
+def closed_length(path):
+    """Return the offset just past the last closed span of a text log.
+    
+    Everything before it can be archived; a span still being written stays.
+    """
+    m = _map_log(path)
+    if m is None:
+        return 0
+    try:
+        opening = _rfind_line(m, "-- Starting log", len(m))
+        if opening >= 0 and _rfind_line(m, "-- Closing log", len(m)) < opening:
+            return opening
+    finally:
+        m.close()
+    return complete_length(path)
+
+def find_last_paid(path):
+    """Return the timestamp of the last [submitted] note in the log, or None."""
+    if is_binary(path):
+        import binlog
+        return binlog.find_last_paid(path)
+    elif is_compressed(path):
+        import archive
+        return archive.find_last_paid(path)
+    m = _map_log(path)
+    if m is None:
+        return None
+    try:
+        position = len(m)
+        while True:
+            position = m.rfind("[Note]", 0, position)
+            if position < 0:
+                return None
+            start = m.rfind('\n', 0, position) + 1
+            event = parse_line(m[start:_line_end(m, position)].strip())
+            if event is not None and event.kind == SUBMITTED:
+                return event.timestamp
+    finally:
+        m.close()
+
+#########
+# Parse checkpoints
+
+CHECKPOINT_VERSION = 3
+
+def checkpoint_path(path):
+    return path + '.checkpoint'
+
+def prefix_digest(path, length, digest=None, start=0, blocksize=1<<20):
+    """md5 of the first length bytes of path.
+    
+    Notices a file that was truncated, rotated or rewritten, and also an
+    edit anywhere in the prefix, such as a corrected note or timestamp.
+    Given the digest of its first start bytes, only the rest is read; the
+    digest passed in is left as it is.
+    """
+    digest = digest.copy() if digest is not None else hashlib.md5()
+    length -= start
+    with open(path, 'r') as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(length, blocksize))
+            if not block:
+                break
+            digest.update(block)
+            length -= len(block)
+    return digest
+
+def prefix_hash(path, length):
+    return prefix_digest(path, length).hexdigest()
+
+def load_checkpoint(path):
+    """Load the parse checkpoint for the log at path.
+    
+    Returns the checkpoint dict, or None if there is none or the parsed
+    prefix of the log has changed since it was written. Spans come back
+    as [first_event, last_event] pairs holding only timestamps and kinds.
+    If the prefix had to be hashed, its md5 object is kept as 'digest' so
+    the next save_checkpoint() can carry it on.
+    """
+    try:
+        with open(checkpoint_path(path), 'r') as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(checkpoint, dict) or checkpoint.get('version') != CHECKPOINT_VERSION:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    try:
+        if stat.st_size < checkpoint['offset']:
+            return None
+        # Unless untouched since the checkpoint was written, check what it parsed.
+        checkpoint['digest'] = None
+        if stat.st_size != checkpoint['size'] or stat.st_mtime != checkpoint['mtime']:
+            checkpoint['digest'] = prefix_digest(path, checkpoint['offset'])
+            if checkpoint['digest'].hexdigest() != checkpoint['hash']:
+                return None
+        checkpoint['spans'] = [[Event(from_epoch(start), START, None, None, None), Event(from_epoch(end), kind, None, None, None)] for start, end, kind in checkpoint['spans']]
+        checkpoint['adjustments'] = [(from_epoch(timestamp), value) for timestamp, value in checkpoint['adjustments']]
+        checkpoint['last_paid'] = from_epoch(checkpoint['last_paid']) if checkpoint['last_paid'] is not None else None
+    except (KeyError, TypeError, ValueError):
+        return None
+    return checkpoint
+
+def save_checkpoint(path, offset, spans, adjustments, last_paid, previous=None):
+    """Record that the log at path has been parsed up to offset.
+    
+    previous is the checkpoint parsing resumed from, if any; its prefix
+    is then not hashed again.
+    """
+    stat = os.stat(path)
+    if previous is None:
+        digest = prefix_digest(path, offset)
+    elif previous['digest'] is not None:
+        digest = prefix_digest(path, offset, previous['digest'], previous['offset'])
+    elif previous['offset'] == offset:
+        digest = None
+    else:
+        digest = prefix_digest(path, offset)
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'offset': offset,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'hash': digest.hexdigest() if digest is not None else previous['hash'],
+        'spans': [[to_epoch(span[0].timestamp), to_epoch(span[-1].timestamp), span[-1].kind] for span in spans],
+        'adjustments': [[to_epoch(timestamp), value] for timestamp, value in adjustments],
+        'last_paid': to_epoch(last_paid) if last_paid is not None else None
+    }
+    temp_path = checkpoint_path(path) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(temp_path, checkpoint_path(path))
+
+#########
+# Writing
+
+fsync_policies = ('never', 'flush', 'close')
+
+class LogWriter(object):
+    """Long-lived, buffered appender for a text log.
+    
+    Lines are held in memory until max_bytes are buffered or the oldest has
+    waited max_delay seconds, then written in a single append. fsync is one
+    of fsync_policies: never, after every flush, or only on close.
+    """
+    def __init__(self, path, max_bytes=4096, max_delay=10, fsync='close'):
+        if fsync not in fsync_policies:
+            raise ValueError, "unknown fsync policy %s" % (fsync,)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.fsync = fsync
+        self.f = open(path, 'a')
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.oldest = None
+
+    def append(self, line):
+        self.buffer.append(line + '\n')
+        self.buffered_bytes += len(line) + 1
+        if self.oldest is None:
+            self.oldest = time.time()
+        if self.buffered_bytes >= self.max_bytes or time.time() - self.oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if self.moved():
+            # The log was rolled into a segment since the last flush; anything
+            # buffered now belongs to the fresh log at the same path.
+            self.f.close()
+            self.f = open(self.path, 'a')
+        if self.buffer:
+            self.f.write(''.join(self.buffer))
+            self.f.flush()
+            if self.fsync == 'flush':
+                os.fsync(self.f.fileno())
+            self.buffer = []
+            self.buffered_bytes = 0
+            self.oldest = None
+
+    def moved(self):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.f.fileno()).st_ino
+        except OSError:
+            return True
+
+    def close(self):
+        self.flush()
+        if self.fsync != 'never':
+            os.fsync(self.f.fileno())
+        self.f.close()